@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Compares fixing chunk ids and looking up subpages in a large DocBook
+# book with XPath queries, which is what pintail used to do, against
+# the id index in pintail.docbook.
+#
+#   PYTHONPATH=. python3 benchmarks/docbook_ids.py [sections]
+#
+# The XPath side is quadratic, and takes minutes at the default of 5000.
+
+import sys
+import time
+
+from lxml import etree
+
+import pintail.docbook
+
+def make_book(sections):
+    # Chapters of 50 sections, most without ids, so ids have to be made
+    book = etree.Element('book')
+    etree.SubElement(book, 'title').text = 'Book'
+    for i in range(sections):
+        if i % 50 == 0:
+            chapter = etree.SubElement(book, 'chapter')
+            etree.SubElement(chapter, 'title').text = 'Chapter %i' % (i // 50)
+        section = etree.SubElement(chapter, 'section')
+        if i % 10 == 0:
+            section.set('id', 'page%i' % (i * 2))
+        etree.SubElement(section, 'title').text = 'Section %i' % i
+        etree.SubElement(section, 'para').text = 'Some text in section %i.' % i
+    return etree.ElementTree(book)
+
+def fix_ids_xpath(tree):
+    fixid = 1
+    def _fixids(node):
+        nonlocal fixid
+        if node.tag in pintail.docbook.DOCBOOK_CHUNKS:
+            if (node.get('id') or node.get(pintail.docbook.XML_NS + 'id')) is None:
+                if node is tree.getroot():
+                    chunkid = 'index'
+                else:
+                    while tree.xpath('count(//*[@id = "%s" or @xml:id = "%s"])' %
+                                     ('page' + str(fixid), 'page' + str(fixid))) > 0:
+                        fixid += 1
+                    chunkid = 'page' + str(fixid)
+                node.set('id', chunkid)
+            for child in node:
+                _fixids(child)
+    _fixids(tree.getroot())
+
+def lookup_xpath(tree, ids):
+    for chunkid in ids:
+        tree.getroot().xpath('//*[@id = "%s" or @xml:id = "%s"]' % (chunkid, chunkid))[0]
+
+def lookup_index(tree, ids):
+    index = pintail.docbook.get_id_index(tree)
+    for chunkid in ids:
+        index[chunkid]
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def main():
+    sections = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    xtree = make_book(sections)
+    xfix = timed(fix_ids_xpath, xtree)
+    itree = make_book(sections)
+    ifix = timed(lambda: pintail.docbook.fix_chunk_ids(
+        itree, pintail.docbook.get_id_index(itree)))
+    assert etree.tostring(xtree) == etree.tostring(itree)
+
+    # Subpage getters used to look up their element once for each of the
+    # title, keywords, and content
+    ids = [el.get('id') for el in itree.iter('chapter', 'section')] * 3
+    xlook = timed(lookup_xpath, itree, ids)
+    ilook = timed(lookup_index, itree, ids)
+
+    print('%i sections, %i lookups' % (sections, len(ids)))
+    print('fix ids:  xpath %.2fs  index %.3fs' % (xfix, ifix))
+    print('lookups:  xpath %.2fs  index %.3fs' % (xlook, ilook))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Measures how long pintail.search.SearchIndex takes to index synthetic
+# pages, and how big the written index is, scaled to 10,000 pages.
+#
+#   PYTHONPATH=. python3 benchmarks/search_index.py [pages] [words]
+
+import random
+import sys
+import time
+
+import pintail.search
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    words = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+
+    rand = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocab = [''.join(rand.choice(letters) for i in range(rand.randint(3, 10)))
+             for j in range(20000)]
+    # Zipf-like word frequencies, like real text
+    cumweights = []
+    total = 0
+    for i in range(len(vocab)):
+        total += 1 / (i + 1)
+        cumweights.append(total)
+    def text(count):
+        return ' '.join(rand.choices(vocab, cum_weights=cumweights, k=count))
+    docs = [('/page%i.html' % i, text(6), text(20), text(5), text(words))
+            for i in range(pages)]
+
+    start = time.perf_counter()
+    index = pintail.search.SearchIndex()
+    for url, title, desc, keywords, content in docs:
+        counts = index.get_term_weights(title=title, desc=desc,
+                                        keywords=keywords, content=content)
+        index.add_document(url, title, desc, counts)
+    added = time.perf_counter()
+    data = index.get_data()
+    done = time.perf_counter()
+
+    scale = 10000 / pages
+    print('%i pages, %i words each' % (pages, words))
+    print('tokenize: %.2fs  write: %.2fs  total: %.2fs per 10k pages' %
+          ((added - start) * scale, (done - added) * scale, (done - start) * scale))
+    print('index size: %.1f KiB per 10k pages (%.1f bytes per page)' %
+          (len(data) * scale / 1024, len(data) / pages))
+
+if __name__ == '__main__':
+    main()
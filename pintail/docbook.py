@@ -14,7 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
 import os
+import re
 import subprocess
 import shutil
 from lxml import etree
@@ -39,6 +42,81 @@ DOCBOOK_INFOS = [
     'referenceinfo', 'sect1info', 'sect2info', 'sect3info', 'sect4info', 'sect5info',
     'sectioninfo', 'setindexinfo']
 
+_string_value = etree.XPath('string(.)')
+
+PUBLICAN_COMMON_CONTENT = '/usr/share/publican/Common_Content'
+
+# Finds the DOCTYPE and the root element name in Publican files, which
+# don't have to be well-formed until their entities are pulled in
+_publican_markup_re = re.compile(r'<!--.*?-->|<\?.*?\?>|(<!DOCTYPE(?:[^\[>]*\[.*?\])?[^>]*>)|<([^\s/>!?]+)',
+                                 re.S)
+
+def get_id_index(tree):
+    # Maps each id to the first element with that id or xml:id, which is
+    # what //*[@id = $id or @xml:id = $id] would find, in one pass.
+    index = {}
+    for el in tree.iter(etree.Element):
+        for attr in ('id', XML_NS + 'id'):
+            value = el.get(attr)
+            if value is not None and value not in index:
+                index[value] = el
+    return index
+
+def fix_chunk_ids(tree, index):
+    # Gives every chunk an id, using ids of the form pageN that aren't
+    # already in index, and adding the new ids to index. Returns True
+    # if any ids were added.
+    root = tree.getroot()
+    fixid = 1
+    fixed = False
+    chunks = [root]
+    while len(chunks) > 0:
+        node = chunks.pop()
+        if node.tag not in DOCBOOK_CHUNKS:
+            continue
+        chunkid = node.get('id') or node.get(XML_NS + 'id')
+        if chunkid is None:
+            if node is root:
+                chunkid = 'index'
+            else:
+                while 'page' + str(fixid) in index:
+                    fixid += 1
+                chunkid = 'page' + str(fixid)
+            if node.tag.startswith(DOCBOOK_NS):
+                node.set(XML_NS + 'id', chunkid)
+            else:
+                node.set('id', chunkid)
+            index.setdefault(chunkid, node)
+            fixed = True
+        chunks.extend(reversed(node))
+    return fixed
+
+class PublicanResolver(etree.Resolver):
+    # Every file in every Publican book pulls in the same entity files
+    # and common content, so keep local files in memory once read.
+    _files = {}
+
+    def resolve(self, url, pubid, context):
+        if url is None:
+            return None
+        path = url
+        if path.startswith('file://'):
+            path = path[7:]
+        if not path.startswith('/'):
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (path, st.st_size, st.st_mtime_ns)
+        data = PublicanResolver._files.get(key)
+        if data is None:
+            with open(path, 'rb') as fd:
+                data = fd.read()
+            PublicanResolver._files[key] = data
+        return self.resolve_string(data, context, base_url=path)
+
+
 class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.CssProvider):
 
     _html_transform = None
@@ -49,8 +127,7 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
         self.pblang = None
 
         pintail.site.Page.__init__(self, directory, source_file)
-        self.stage_page()
-        self._tree = etree.parse(self.get_stage_path())
+        self._tree = self.stage_page()
         maxdepth = 1
         if self._tree.getroot().tag in ('book', DOCBOOK_NS + 'book'):
             maxdepth = 2
@@ -62,28 +139,8 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
                 pass
         self.maxdepth = maxdepth
 
-        self._fixed = False
-        self._fixid = 1
-        def _fixids(node):
-            if node.tag in DOCBOOK_CHUNKS:
-                chunkid = node.get('id') or node.get(XML_NS + 'id')
-                if chunkid is None:
-                    if node is self._tree.getroot():
-                        chunkid = 'index'
-                    else:
-                        while self._tree.xpath('count(//*[@id = "%s" or @xml:id = "%s"])' %
-                                               ('page' + str(self._fixid), 'page' + str(self._fixid))) > 0:
-                            self._fixid += 1
-                        chunkid = 'page' + str(self._fixid)
-                    if node.tag.startswith(DOCBOOK_NS):
-                        node.set(XML_NS + 'id', chunkid)
-                    else:
-                        node.set('id', chunkid)
-                    self._fixed = True
-                for child in node:
-                    _fixids(child)
-        _fixids(self._tree.getroot())
-        if self._fixed:
+        self._id_index = get_id_index(self._tree)
+        if fix_chunk_ids(self._tree, self._id_index):
             self._tree.write(self.get_stage_path())
 
         def _accumulate_pages(node, depth, maxdepth):
@@ -96,19 +153,56 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
             return ret
         pages = _accumulate_pages(self._tree.getroot(), 1, maxdepth)
         self.subpages = [DocBookSubPage(self, el) for el in pages]
-        self._langtrees = {}
+        self._langs = set()
         self._notlangs = set()
+        self._media = None
+        self.site.tree_cache.hold_page(self)
+
+    def __getstate__(self):
+        state = pintail.site.Page.__getstate__(self)
+        state['_id_index'] = None
+        return state
 
     def _get_tree(self, lang=None):
+        if self._tree is None:
+            self._tree = etree.parse(self.get_stage_path())
+            self._id_index = None
+        self.site.tree_cache.hold_page(self)
         if lang is None or lang in self._notlangs:
             return self._tree
-        if lang in self._langtrees:
-            return self._langtrees[lang]
-        if self.site.translate_page(self, lang):
-            self._langtrees[lang] = etree.parse(self.get_stage_path(lang))
-            return self._langtrees[lang]
-        self._notlangs.add(lang)
-        return self._tree
+        if not self._is_translated(lang):
+            return self._tree
+        return self.site.tree_cache.get_tree(self.get_stage_path(lang))
+
+    def _is_translated(self, lang):
+        if lang in self._notlangs:
+            return False
+        if lang not in self._langs:
+            if not self.site.translate_page(self, lang):
+                self._notlangs.add(lang)
+                return False
+            # The translation may have been rewritten since we last saw it.
+            self.site.tree_cache.discard(self.get_stage_path(lang))
+            self._langs.add(lang)
+        return True
+
+    def get_id_index(self, lang=None):
+        # Each tree's index is built once. Translated trees keep theirs in
+        # the tree cache, so it goes away when the tree does.
+        if lang is not None and lang not in self._notlangs and self._is_translated(lang):
+            return self.site.tree_cache.get_tree_data(self.get_stage_path(lang),
+                                                      'docbook-ids', get_id_index)
+        tree = self._get_tree()
+        if self._id_index is None:
+            self._id_index = get_id_index(tree)
+        return self._id_index
+
+    def release_tree(self):
+        if self._tree is not None:
+            pintail.site.Page.release_tree(self)
+            self._id_index = None
+            for page in self.subpages:
+                page._summaries = {None: page._summaries[None]}
 
     @property
     def page_id(self):
@@ -124,14 +218,14 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
             if child.tag in DOCBOOK_INFOS:
                 for info in child:
                     if info.tag in ('title', DOCBOOK_NS + 'title'):
-                        title = info.xpath('string(.)')
+                        title = _string_value(info)
             elif child.tag in ('title', DOCBOOK_NS + 'title'):
-                title = child.xpath('string(.)')
+                title = _string_value(child)
                 break
         return title
 
     def get_title(self, hint=None, lang=None):
-        return self.get_title_node(self._get_tree(lang).getroot(), hint=hint)
+        return self.get_summary(lang).get_title(hint)
 
     def get_keywords_node(self, node, hint=None):
         keywords = ''
@@ -143,89 +237,123 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
                             if keyword.tag in ('keyword', DOCBOOK_NS + 'keyword'):
                                 if keywords != '':
                                     keywords += ', '
-                                keywords += keyword.xpath('string(.)')
+                                keywords += _string_value(keyword)
                 break
         return keywords
 
     def get_keywords(self, hint=None, lang=None):
-        return self.get_keywords_node(self._get_tree(lang).getroot(), hint=hint)
+        return self.get_summary(lang).keywords
 
-    def get_content_node(self, node, hint=None):
+    def iter_content_node(self, node, hint=None):
+        # Yields the text inside node without recursion, leaving out the
+        # contents of info elements and, above maxdepth, other chunks.
         depth = 0
         parent = node.getparent()
         while parent is not None:
             depth += 1
             parent = parent.getparent()
-        def _accumulate_text(node):
-            ret = ''
-            for child in node:
-                if not isinstance(child.tag, str):
-                    continue
-                if node.tag in DOCBOOK_INFOS:
-                    continue
-                if depth < self.maxdepth and child.tag in DOCBOOK_CHUNKS:
-                    continue
-                ret += child.text or ''
-                ret += _accumulate_text(child)
-                ret += child.tail or ''
-            return ret
-        return _accumulate_text(node)
+        walker = etree.iterwalk(node, events=('start', 'end'))
+        tags = []
+        skipped = False
+        for event, el in walker:
+            if event == 'start':
+                if len(tags) > 0 and (tags[-1] in DOCBOOK_INFOS or
+                                      (depth < self.maxdepth and el.tag in DOCBOOK_CHUNKS)):
+                    # The next event is the end of this element
+                    walker.skip_subtree()
+                    skipped = True
+                elif len(tags) > 0 and el.text is not None:
+                    yield el.text
+                tags.append(el.tag)
+            else:
+                tags.pop()
+                if skipped:
+                    skipped = False
+                elif len(tags) > 0 and el.tail is not None:
+                    yield el.tail
+
+    def get_content_node(self, node, hint=None):
+        return ''.join(self.iter_content_node(node, hint=hint))
 
     def get_content(self, hint=None, lang=None):
-        return self.get_content_node(self._get_tree(lang).getroot(), hint=hint)
+        return ''.join(self.iter_content(hint=hint, lang=lang))
+
+    def iter_content(self, hint=None, lang=None):
+        return self.iter_content_node(self._get_tree(lang).getroot(), hint=hint)
+
+    def summarize(self, lang=None):
+        # Summarizes the book and all of its subpages at once. Text isn't
+        # kept, because only search needs it; get_content extracts it.
+        root = self._get_tree(lang).getroot()
+        summary = pintail.site.PageSummary()
+        for node in root.iter(etree.Element):
+            src = node.get('fileref')
+            if src is not None and ':' not in src:
+                summary.media.add(src)
+            href = node.get(XLINK_NS + 'href')
+            if href is not None and ':' not in href:
+                summary.media.add(href)
+            if node.tag == 'ulink':
+                href = node.get('url')
+                if href is not None and ':' not in href:
+                    summary.media.add(href)
+        summary.titles[None] = self.get_title_node(root)
+        summary.keywords = self.get_keywords_node(root)
+        index = self.get_id_index(lang)
+        for page in self.subpages:
+            subsummary = pintail.site.PageSummary()
+            el = index.get(page.page_id)
+            if el is not None:
+                subsummary.titles[None] = self.get_title_node(el)
+                subsummary.keywords = self.get_keywords_node(el)
+            page._summaries[lang] = subsummary
+        return summary
 
     @classmethod
     def build_tools(cls, site):
+        # The stylesheets may have changed, so compile them again
+        DocBookPage._html_transform = None
         db2html = os.path.join(site.yelp_xsl_path, 'xslt', 'docbook', 'html', 'db2html.xsl')
         mallink = os.path.join(site.yelp_xsl_path, 'xslt', 'mallard', 'common', 'mal-link.xsl')
 
-        fd = open(os.path.join(site.tools_path, 'pintail-html-docbook-local.xsl'), 'w')
-        fd.write('<xsl:stylesheet' +
-                 ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
-                 ' version="1.0">\n' +
-                 '<xsl:import href="pintail-html-docbook.xsl"/>\n' +
-                 '<xsl:param name="db.chunk.extension" select="$pintail.extension.link"/>\n')
-        for xsl in site.get_custom_xsl():
-            fd.write('<xsl:include href="%s"/>\n' % xsl)
-        fd.write('</xsl:stylesheet>')
-        fd.close()
-
-        fd = open(os.path.join(site.tools_path, 'pintail-html-docbook.xsl'), 'w')
-        fd.write(('<xsl:stylesheet' +
-                  ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
-                  ' version="1.0">\n' +
-                  '<xsl:import href="%s"/>\n' +
-                  '<xsl:import href="%s"/>\n' +
-                  '<xsl:include href="%s"/>\n' +
-                  '</xsl:stylesheet>\n')
-                 % (db2html, mallink, 'pintail-html.xsl'))
-        fd.close()
+        site._write_tools_file('pintail-html-docbook-local.xsl',
+                               '<xsl:stylesheet' +
+                               ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
+                               ' version="1.0">\n' +
+                               '<xsl:import href="pintail-html-docbook.xsl"/>\n' +
+                               '<xsl:param name="db.chunk.extension" select="$pintail.extension.link"/>\n' +
+                               ''.join(['<xsl:include href="%s"/>\n' % xsl
+                                        for xsl in site.get_custom_xsl()]) +
+                               '</xsl:stylesheet>')
+
+        site._write_tools_file('pintail-html-docbook.xsl',
+                               ('<xsl:stylesheet' +
+                                ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
+                                ' version="1.0">\n' +
+                                '<xsl:import href="%s"/>\n' +
+                                '<xsl:import href="%s"/>\n' +
+                                '<xsl:include href="%s"/>\n' +
+                                '</xsl:stylesheet>\n')
+                               % (db2html, mallink, 'pintail-html.xsl'))
 
     @classmethod
     def build_css(cls, site):
         xslpath = os.path.join(site.yelp_xsl_path, 'xslt')
 
-        pintail.site.Site._makedirs(site.tools_path)
-        cssxsl = os.path.join(site.tools_path, 'pintail-css-docbook.xsl')
-        fd = open(cssxsl, 'w')
-        fd.writelines([
+        xsl = ''.join([
             '<xsl:stylesheet',
             ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"',
-            ' xmlns:exsl="http://exslt.org/common"',
-            ' extension-element-prefixes="exsl"',
             ' version="1.0">\n',
             '<xsl:import href="' + xslpath + '/common/l10n.xsl"/>\n',
             '<xsl:import href="' + xslpath + '/common/color.xsl"/>\n',
             '<xsl:import href="' + xslpath + '/common/icons.xsl"/>\n',
             '<xsl:import href="' + xslpath + '/common/html.xsl"/>\n',
-            '<xsl:import href="' + xslpath + '/docbook/html/db2html-css.xsl"/>\n'
-            ])
-        fd.write('<xsl:import href="%s"/>\n' % 'pintail-html.xsl')
-        for xsl in site.get_custom_xsl():
-            fd.write('<xsl:include href="%s"/>\n' % xsl)
-        fd.writelines([
+            '<xsl:import href="' + xslpath + '/docbook/html/db2html-css.xsl"/>\n',
+            '<xsl:import href="%s"/>\n' % 'pintail-html.xsl'
+            ] + [
+            '<xsl:include href="%s"/>\n' % custom for custom in site.get_custom_xsl()
+            ] + [
             '<xsl:output method="text"/>\n',
-            '<xsl:param name="out"/>\n',
             '<xsl:template match="/">\n',
             '<xsl:for-each select="/*">\n',
             '<xsl:variable name="locale">\n',
@@ -241,59 +369,53 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
             '  </xsl:otherwise>\n',
             ' </xsl:choose>\n',
             '</xsl:variable>\n',
-            '<exsl:document href="{$out}" method="text">\n',
-            ' <xsl:call-template name="html.css.content"/>\n',
-            '</exsl:document>\n',
+            '<xsl:call-template name="html.css.content"/>\n',
             '</xsl:for-each>\n',
             '</xsl:template>\n'
             '</xsl:stylesheet>\n'
             ])
-        fd.close()
 
-        seenlangs = []
+        # Only the root element is needed to find the locale, so don't
+        # build trees unless a locale has to be rendered.
+        docs = []
+        seenlangs = set()
         for page in site.root.iter_pages():
             if not isinstance(page, DocBookPage):
                 continue
             for lc in [None] + site.get_langs():
+                if lc is not None and not page._is_translated(lc):
+                    continue
                 try:
-                    doc = page._get_tree(lc).getroot()
-                    lang = doc.get(XML_NS + 'lang', doc.get('lang', 'C'))
-                except:
+                    for event, doc in etree.iterparse(page.get_stage_path(lc),
+                                                      events=('start',)):
+                        lang = doc.get(XML_NS + 'lang', doc.get('lang', 'C'))
+                        break
+                except (OSError, etree.Error):
                     continue
                 if lang in seenlangs:
                     continue
-                seenlangs.append(lang)
-                cssfile = 'pintail-docbook-' + lang + '.css'
-                csspath = os.path.join(site.target_path, cssfile)
-                site.log('CSS', '/' + cssfile)
-                subprocess.call(['xsltproc',
-                                 '-o', site.target_path,
-                                 '--stringparam', 'out', csspath,
-                                 cssxsl, page.get_stage_path(lc)])
-                custom_css = site.config.get('custom_css')
-                if custom_css is not None:
-                    custom_css = os.path.join(site.topdir, custom_css)
-                    fd = open(csspath, 'a')
-                    fd.write(open(custom_css).read())
-                    fd.close()
+                seenlangs.add(lang)
+                docs.append((lang, lambda page=page, lc=lc: page._get_tree(lc), {}))
+        site.build_css_files('docbook', xsl, docs)
 
     def _rewrite_publican_xml_file(self, source, target, entfile):
-        p = subprocess.Popen(['xmllint', '--dropdtd', source],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        lines = p.communicate()[0].decode('utf-8').split('\n')
+        with open(source, encoding='utf-8') as fd:
+            text = fd.read()
         decl = None
-        if lines[0].startswith('<?xml'):
-            decl = lines.pop(0)
+        if text.startswith('<?xml'):
+            end = text.index('?>') + 2
+            decl = text[:end]
+            text = text[end:].lstrip('\r\n')
         el = None
-        for line in lines:
-            if '<' in line:
-                el = line[line.index('<')+1:]
-                if el[0] != '!':
-                    if ' ' in el:
-                        el = el[:el.index(' ')]
-                    elif '>' in el:
-                        el = el[:el.index('>')]
-                    break
+        dropdtd = None
+        for match in _publican_markup_re.finditer(text):
+            if match.group(1) is not None:
+                dropdtd = match.span()
+            elif match.group(2) is not None:
+                el = match.group(2)
+                break
+        if dropdtd is not None:
+            text = text[:dropdtd[0]] + text[dropdtd[1]:].lstrip('\r\n')
         doctype = '<!DOCTYPE %s PUBLIC ' % el
         if self.pbdoctype.startswith('4.'):
             doctype += '"-//OASIS//DTD DocBook XML V%s//EN" ' % self.pbdoctype
@@ -306,18 +428,85 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
             doctype += '<!ENTITY %% BOOK_ENTITIES SYSTEM "%s">\n' % entfile
             doctype += '%BOOK_ENTITIES;\n'
         doctype += ']>\n'
-        fd = open(target, 'w')
-        if decl is not None:
-            fd.write(decl + '\n')
-        fd.write(doctype)
-        for line in lines:
-            fd.write(line + '\n')
-        fd.close()
+        tmp = '%s.pintail-tmp%i' % (target, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as fd:
+            if decl is not None:
+                fd.write(decl + '\n')
+            fd.write(doctype)
+            fd.write(text)
+        os.replace(tmp, target)
+
+    def _rewrite_publican_files(self, sources, targetdir, entfile):
+        # Rewrites files into targetdir, skipping files whose source and
+        # DOCTYPE haven't changed since they were last written. Digests
+        # are kept next to the rewritten files.
+        stampfile = os.path.join(targetdir, 'pintail-publican.json')
+        try:
+            with open(stampfile) as fd:
+                stamps = json.load(fd)
+        except (OSError, ValueError):
+            stamps = {}
+        newstamps = {}
+        for source in sources:
+            bname = os.path.basename(source)
+            target = os.path.join(targetdir, bname)
+            with open(source, 'rb') as fd:
+                sha = hashlib.sha1(fd.read())
+            digest = pintail.site.Manifest.get_digest(sha.hexdigest(), self.pbdoctype, entfile)
+            newstamps[bname] = digest
+            if stamps.get(bname) == digest and os.path.exists(target):
+                continue
+            self._rewrite_publican_xml_file(source, target, entfile)
+        if newstamps != stamps:
+            tmp = '%s.pintail-tmp%i' % (stampfile, os.getpid())
+            with open(tmp, 'w') as fd:
+                json.dump(newstamps, fd, sort_keys=True)
+            os.replace(tmp, stampfile)
+
+    # Rewritten Common_Content directories that are known to be current
+    # in this process, by brand, language, and DocBook version
+    _publican_common = {}
+
+    def _get_publican_common(self):
+        # Common content is rewritten once for each brand and language,
+        # and shared by every book. It references the book's entities
+        # through pintail-publican.ent, which each book puts next to its
+        # own Common_Content directory.
+        cachedir = os.path.join(self.site.pindir, 'publican',
+                                self.pbdoctype, self.pbbrand, self.pblang)
+        if cachedir not in DocBookPage._publican_common:
+            branddir = os.path.join(PUBLICAN_COMMON_CONTENT, self.pbbrand, self.pblang)
+            commondir = os.path.join(PUBLICAN_COMMON_CONTENT, 'common', self.pblang)
+            files = {}
+            for srcdir in (commondir, branddir):
+                if not os.path.isdir(srcdir):
+                    continue
+                for xml in os.listdir(srcdir):
+                    filename = os.path.join(srcdir, xml)
+                    if xml.endswith('.xml') and os.path.isfile(filename):
+                        # Brand files override common files
+                        files[xml] = filename
+            pintail.site.Site._makedirs(cachedir)
+            self._rewrite_publican_files([files[xml] for xml in sorted(files)],
+                                         cachedir, '../pintail-publican.ent')
+            DocBookPage._publican_common[cachedir] = sorted(files)
+        return cachedir, DocBookPage._publican_common[cachedir]
+
+    @classmethod
+    def _write_publican_file(cls, path, data):
+        try:
+            with open(path, 'rb') as fd:
+                if fd.read() == data:
+                    return
+        except OSError:
+            pass
+        with open(path, 'wb') as fd:
+            fd.write(data)
 
     def _stage_page_publican(self):
         # Publican does some weird things to DocBook, including rewriting the DOCTYPE
         # in a way that lets you write non-well-formed XML that can't be read by any
-        # other tool. Pintail can pretend to be Publican.
+        # other tool. Pintail can pretend to be Publican. Returns the baked tree.
         pbdir = os.path.join(self.directory.get_stage_path(), '__publican__')
         pintail.site.Site._makedirs(pbdir)
 
@@ -340,60 +529,72 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
         # same basename if available. This is the craziness Publican does.
         xmlfiles = []
         entfile = None
+        entdata = b''
         dpath = self.directory.get_source_path()
-        for xml in os.listdir(dpath):
+        for xml in sorted(os.listdir(dpath)):
             if not os.path.isfile(os.path.join(dpath, xml)):
                 continue
             if xml.endswith('.xml'):
-                xmlfiles.append(xml)
+                xmlfiles.append(os.path.join(dpath, xml))
             elif xml == os.path.splitext(self.source_file)[0] + '.ent':
                 entfile = xml
-                shutil.copyfile(os.path.join(dpath, entfile), os.path.join(pbdir, entfile))
-        for xml in xmlfiles:
-            self._rewrite_publican_xml_file(os.path.join(dpath, xml),
-                                            os.path.join(pbdir, xml),
-                                            entfile)
+                with open(os.path.join(dpath, entfile), 'rb') as fd:
+                    entdata = fd.read()
+                self._write_publican_file(os.path.join(pbdir, entfile), entdata)
+        self._rewrite_publican_files(xmlfiles, pbdir, entfile)
 
         # Publican also ships "common content", some of which is required
         # for parsing. But even the common content has to be rewritten to
         # reference the .ent file in your repo. We can only do this if we
         # found a brand and language in publican.cfg.
         if self.pbbrand is not None and self.pblang is not None:
+            self._write_publican_file(os.path.join(pbdir, 'pintail-publican.ent'), entdata)
+            cachedir, names = self._get_publican_common()
             ccdir = os.path.join(pbdir, 'Common_Content')
             pintail.site.Site._makedirs(ccdir)
-            branddir = os.path.join('/usr/share/publican/Common_Content/', self.pbbrand, self.pblang)
-            commondir = os.path.join('/usr/share/publican/Common_Content/common/', self.pblang)
-            brandfiles = [os.path.join(branddir, xml) for xml in os.listdir(branddir)]
-            commonfiles = [os.path.join(commondir, xml) for xml in os.listdir(commondir)]
-            donefiles = set()
-            for filename in brandfiles + commonfiles:
-                bname = os.path.basename(filename)
-                if bname in donefiles:
+            for bname in names:
+                source = os.path.join(cachedir, bname)
+                target = os.path.join(ccdir, bname)
+                if os.path.exists(target) and os.path.samefile(source, target):
                     continue
-                if not os.path.isfile(filename):
-                    continue
-                if filename.endswith('.xml'):
-                    donefiles.add(bname)
-                    self._rewrite_publican_xml_file(filename,
-                                                    os.path.join(ccdir, bname),
-                                                    '../' + entfile)
+                pintail.site.Site._copy_file(source, target, hardlink=True)
 
         # Finally, make a baked XML file in the location the rest of Pintail expects.
-        subprocess.call(['xmllint', '--xinclude', '--noent', '--loaddtd',
-                         '-o', self.get_stage_path(),
-                         os.path.join(pbdir, self.source_file)])
+        parser = etree.XMLParser(load_dtd=True, resolve_entities=True,
+                                 no_network=self.site.config.get_offline())
+        parser.resolvers.add(PublicanResolver())
+        tree = etree.parse(os.path.join(pbdir, self.source_file), parser)
+        tree.xinclude()
+        tree.write(self.get_stage_path(), xml_declaration=True, encoding='utf-8')
+        return tree
+
+    def get_dependencies(self):
+        source = self.get_source_path()
+        ret = [source]
+        if self.pbdoctype is None:
+            ret.extend(self.site.manifest.get_xinclude_dependencies(source))
+        # Publican books and entity files can pull in anything nearby
+        dpath = self.directory.get_source_path()
+        for fname in sorted(os.listdir(dpath)):
+            if fname.endswith('.ent') or (self.pbdoctype is not None and
+                                          (fname.endswith('.xml') or fname == 'publican.cfg')):
+                ret.append(os.path.join(dpath, fname))
+        return ret
 
     def stage_page(self):
         pintail.site.Site._makedirs(self.directory.get_stage_path())
         self.pbdoctype = self.site.config.get('publican_doctype', self.directory.path)
         if self.pbdoctype is not None:
-            self._stage_page_publican()
-        else:
-            subprocess.call(['xmllint', '--xinclude', '--noent',
-                             '-o', self.get_stage_path(),
-                             self.get_source_path()])
+            return self._stage_page_publican()
+        parser = etree.XMLParser(resolve_entities=True)
+        tree = etree.parse(self.get_source_path(), parser)
+        tree.xinclude()
+        tree.write(self.get_stage_path(), xml_declaration=True, encoding='utf-8')
+        return tree
 
     def get_cache_data(self, lang=None):
+        if lang is None and self._cache_data is not None:
+            return etree.fromstring(self._cache_data)
         ret = None
         try:
             ret = etree.Element(PINTAIL_NS + 'external')
@@ -462,21 +663,9 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
         subprocess.call(cmd)
 
     def get_media(self):
-        refs = set()
-        def _accumulate_refs(node):
-            src = node.get('fileref', None)
-            if src is not None and ':' not in src:
-                refs.add(src)
-            href = node.get(XLINK_NS + 'href', None)
-            if href is not None and ':' not in href:
-                refs.add(href)
-            if node.tag == 'ulink':
-                href = node.get('url', None)
-                if href is not None and ':' not in href:
-                    refs.add(href)
-            for child in node:
-                _accumulate_refs(child)
-        _accumulate_refs(self._tree.getroot())
+        if self._media is not None:
+            return self._media
+        refs = self.get_summary().media
 
         # If files don't exist, but Publican provides them, stage them.
         if self.pbbrand is not None and self.pblang is not None:
@@ -490,18 +679,19 @@ class DocBookPage(pintail.site.Page, pintail.site.ToolsProvider, pintail.site.Cs
                     rref = ref[15:]
                 else:
                     continue
-                tryref = os.path.join('/usr/share/publican/Common_Content/', self.pbbrand, self.pblang, rref)
+                tryref = os.path.join(PUBLICAN_COMMON_CONTENT, self.pbbrand, self.pblang, rref)
                 if os.path.exists(tryref):
                     self.site.log('STAGE', self.directory.path + ref)
                     pintail.site.Site._makedirs(os.path.dirname(stagepath))
                     shutil.copyfile(tryref, stagepath)
                     continue
-                tryref = os.path.join('/usr/share/publican/Common_Content/common/', self.pblang, rref)
+                tryref = os.path.join(PUBLICAN_COMMON_CONTENT, 'common', self.pblang, rref)
                 if os.path.exists(tryref):
                     self.site.log('STAGE', self.directory.path + ref)
                     pintail.site.Site._makedirs(os.path.dirname(stagepath))
                     shutil.copyfile(tryref, stagepath)
 
+        self._media = refs
         return refs
 
     @classmethod
@@ -526,17 +716,28 @@ class DocBookSubPage(pintail.site.Page):
     def searchable(self):
         return True
 
+    def get_dependencies(self):
+        return self._db_page.get_dependencies()
+
+    def get_element(self, lang=None):
+        return self._db_page.get_id_index(lang).get(self._sect_id)
+
+    def iter_content(self, hint=None, lang=None):
+        el = self.get_element(lang)
+        if el is None:
+            return iter([])
+        return self._db_page.iter_content_node(el, hint=hint)
+
+    def summarize(self, lang=None):
+        # The book page summarizes all of its subpages at once
+        self._db_page._summaries[lang] = self._db_page.summarize(lang)
+        return self._summaries[lang]
+
     def get_title(self, hint=None, lang=None):
-        el = self._db_page._get_tree(lang).getroot().xpath('//*[@id = "%s" or @xml:id = "%s"]' %
-                                                           (self._sect_id, self._sect_id))
-        return self._db_page.get_title_node(el[0], hint=hint)
+        return self.get_summary(lang).get_title(hint)
 
     def get_keywords(self, hint=None, lang=None):
-        el = self._db_page._get_tree(lang).getroot().xpath('//*[@id = "%s" or @xml:id = "%s"]' %
-                                                           (self._sect_id, self._sect_id))
-        return self._db_page.get_keywords_node(el[0], hint=hint)
+        return self.get_summary(lang).keywords
 
     def get_content(self, hint=None, lang=None):
-        el = self._db_page._get_tree(lang).getroot().xpath('//*[@id = "%s" or @xml:id = "%s"]' %
-                                                           (self._sect_id, self._sect_id))
-        return self._db_page.get_content_node(el[0], hint=hint)
+        return ''.join(self.iter_content(hint=hint, lang=lang))
@@ -14,11 +14,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import subprocess
 
+from lxml import etree
+
 import pintail.site
 import pintail.mallard
 
+try:
+    import mallard.ducktype
+except ImportError:
+    mallard = None
+
 class DucktypePage(pintail.mallard.MallardPage):
     def __init__(self, directory, source_file):
         pintail.mallard.MallardPage.__init__(self, directory, source_file)
@@ -30,16 +38,67 @@ class DucktypePage(pintail.mallard.MallardPage):
         else:
             return self.source_file
 
+    def get_dependencies(self):
+        return [self.get_source_path()]
+
+    @classmethod
+    def stage_directory(cls, directory):
+        # Without the ducktype module, convert every changed file in the
+        # directory with a single ducktype command, rather than starting
+        # a new Python process for each file.
+        if mallard is not None:
+            return
+        sources = []
+        for name in directory.get_page_files():
+            if not name.endswith('.duck'):
+                continue
+            source = os.path.join(directory.get_source_path(), name)
+            stage = os.path.join(directory.get_stage_path(), name[:-5] + '.page')
+            if not directory.site.manifest.is_stage_current(stage, [source]):
+                sources.append(source)
+        if len(sources) < 2:
+            return
+        pintail.site.Site._makedirs(directory.get_stage_path())
+        stages = [os.path.join(directory.get_stage_path(),
+                               os.path.basename(source)[:-5] + '.page')
+                  for source in sources]
+        ret = subprocess.call(['ducktype', '-o', os.path.join(directory.get_stage_path(), '')] + sources)
+        if ret != 0:
+            # We can't tell which files converted. Remove them all, so
+            # stage_page converts each one again and reports the failure.
+            for stage in stages:
+                if os.path.exists(stage):
+                    os.remove(stage)
+            return
+        for source, stage in zip(sources, stages):
+            directory.site.manifest.set_stage_current(stage, [source])
+
     def stage_page(self):
         pintail.site.Site._makedirs(self.directory.get_stage_path())
-        subprocess.call(['ducktype',
-                         '-o', self.get_stage_path(),
-                         self.get_source_path()])
+        if not self.is_stage_current():
+            try:
+                if mallard is not None:
+                    parser = mallard.ducktype.DuckParser()
+                    parser.parse_file(self.get_source_path())
+                    parser.finish()
+                    parser.document.write_xml(self.get_stage_path())
+                else:
+                    subprocess.check_call(['ducktype',
+                                           '-o', self.get_stage_path(),
+                                           self.get_source_path()])
+            except Exception:
+                # Don't leave an old staged file behind to be read, or to
+                # be recorded as current on the next build.
+                if os.path.exists(self.get_stage_path()):
+                    os.remove(self.get_stage_path())
+                raise
+            self._staged = True
+        tree = etree.parse(self.get_stage_path())
+        tree.xinclude()
+        return tree
 
     @classmethod
     def get_pages(cls, directory, filename):
         if filename.endswith('.duck'):
             return [DucktypePage(directory, filename)]
         return []
-
-
@@ -14,37 +14,170 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import json
 import os
 import subprocess
+import weakref
 
 import pintail.site
 
-class GitDirectory(pintail.site.Directory, pintail.site.XslProvider):
-    def __init__(self, site, path, *, parent=None):
-        self.repo = site.config.get('git_repository', path)
-        self.branch = site.config.get('git_branch', path) or 'master'
-        self.repodir = (self.repo.replace('/', '!') + '@@' +
-                        self.branch.replace('/', '!'))
-        self.absrepodir = os.path.join(site.pindir, 'git', self.repodir)
-
-        if os.path.exists(self.absrepodir):
-            if site.config._update and site.config.get('git_update', path) != 'false':
-                site.log('UPDATE', self.repo + '@' + self.branch)
-                p = subprocess.Popen(['git', 'pull', '-q', '-r',
-                                      'origin', self.branch],
-                                     cwd=self.absrepodir)
-                p.communicate()
+class GitFetcher:
+    # Clones or updates every git_repository in the config at once, with
+    # up to git_jobs fetches running at a time. Each GitDirectory only
+    # waits for its own repository, so pages from repositories that are
+    # done can be read while the rest are still fetching.
+    def __init__(self, site):
+        self.site = site
+        try:
+            jobs = max(int(site.config.get('git_jobs') or 4), 1)
+        except ValueError:
+            jobs = 4
+        try:
+            self.timeout = float(site.config.get('git_timeout') or 600)
+        except ValueError:
+            self.timeout = 600
+        self._futures = {}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        for path in sorted(site.config.get_directories(), key=len):
+            if site.config.get('git_repository', path) is None:
+                continue
+            repo, branch, absrepodir = GitDirectory.get_repository(site, path)
+            if absrepodir in self._futures:
+                continue
+            self._futures[absrepodir] = executor.submit(self._fetch, path, repo,
+                                                        branch, absrepodir)
+        executor.shutdown(wait=False)
+
+    def _fetch(self, path, repo, branch, absrepodir):
+        # Returns the commit id from before the fetch, or None if there
+        # wasn't a checkout or the fetch failed.
+        site = self.site
+        before = pintail.site.Site.get_git_commit(absrepodir)
+        if os.path.exists(absrepodir):
+            if (not site.config._update or site.config.get_offline() or
+                site.config.get('git_update', path) == 'false'):
+                return before
+            site.log('UPDATE', repo + '@' + branch)
+            cmd = ['git', 'pull', '-q', '-r', 'origin', branch]
+            cwd = absrepodir
+        elif site.config.get_offline():
+            site.logger.error('Cannot find %s while offline' % absrepodir)
+            return None
         else:
-            site.log('CLONE', self.repo + '@' + self.branch)
+            site.log('CLONE', repo + '@' + branch)
             pintail.site.Site._makedirs(os.path.join(site.pindir, 'git'))
-            p = subprocess.Popen(['git', 'clone', '-q',
-                                  '-b', self.branch, '--depth=1',
-                                  self.repo, self.repodir],
-                                 cwd=os.path.join(site.pindir, 'git'))
-            p.communicate()
+            cmd = ['git', 'clone', '-q', '-b', branch, '--depth=1',
+                   repo, os.path.basename(absrepodir)]
+            cwd = os.path.dirname(absrepodir)
+        try:
+            p = subprocess.run(cmd, cwd=cwd, timeout=self.timeout,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+        except subprocess.TimeoutExpired:
+            site.logger.error('Timed out fetching %s@%s after %g seconds' %
+                              (repo, branch, self.timeout))
+            return None
+        except OSError as e:
+            site.logger.error('Failed to fetch %s@%s: %s' % (repo, branch, e))
+            return None
+        if p.returncode != 0:
+            site.logger.error('Failed to fetch %s@%s: %s' %
+                              (repo, branch, p.stderr.strip()))
+            return None
+        return before
+
+    def wait(self, absrepodir):
+        future = self._futures.get(absrepodir)
+        if future is None:
+            return None
+        return future.result()
+
+
+class GitDirectory(pintail.site.Directory, pintail.site.XslProvider):
+    _fetchers = weakref.WeakKeyDictionary()
+
+    def __init__(self, site, path, *, parent=None):
+        self.repo, self.branch, self.absrepodir = GitDirectory.get_repository(site, path)
+        self.repodir = os.path.basename(self.absrepodir)
+
+        fetcher = GitDirectory._fetchers.get(site)
+        if fetcher is None:
+            fetcher = GitDirectory._fetchers[site] = GitFetcher(site)
+        before = fetcher.wait(self.absrepodir)
+        self.record_changes(site, path, before)
 
         super().__init__(site, path, parent=parent)
 
+    def record_changes(self, site, path, before):
+        # Record the commits from before and after the fetch in
+        # __pintail__/git/, and tell the manifest which source files
+        # changed since the commit the last build saw. Everything else
+        # in the checkout is trusted without checking the files.
+        after = pintail.site.Site.get_git_commit(self.absrepodir)
+        subdir = site.config.get('git_directory', path) or ''
+        built = site.manifest.get_record('git', path)
+        changed = None
+        if built is not None and after is not None:
+            if built == after:
+                changed = []
+            else:
+                try:
+                    out = subprocess.check_output(['git', 'diff', '--name-only',
+                                                   built, after, '--', subdir or '.'],
+                                                  cwd=self.absrepodir,
+                                                  stderr=subprocess.DEVNULL,
+                                                  universal_newlines=True)
+                    changed = [os.path.join(self.absrepodir, name)
+                               for name in out.splitlines() if name != '']
+                except (OSError, subprocess.CalledProcessError):
+                    changed = None
+        if changed is not None:
+            site.manifest.set_unchanged_tree(os.path.join(self.absrepodir, subdir),
+                                             changed)
+            # The record moves to the new commit now, so hash the changed
+            # files now too. Otherwise a command that doesn't hash page
+            # sources would save the old hashes as if they were current.
+            for name in changed:
+                site.manifest.get_file_hash(name)
+        site.manifest.set_record('git', path, after)
+
+        statepath = self.absrepodir + '.json'
+        try:
+            with open(statepath, encoding='utf-8') as fd:
+                state = json.load(fd)
+        except (OSError, ValueError):
+            state = {}
+        state['before'] = before
+        state['after'] = after
+        state.setdefault('changed', {})[path] = (
+            None if changed is None else
+            [os.path.relpath(name, self.absrepodir) for name in changed])
+        if os.path.isdir(os.path.dirname(statepath)):
+            with open(statepath, 'w', encoding='utf-8') as fd:
+                json.dump(state, fd, sort_keys=True, indent=1)
+
+    @classmethod
+    def get_repository(cls, site, path):
+        repo = site.config.get('git_repository', path)
+        branch = site.config.get('git_branch', path) or 'master'
+        repodir = (repo.replace('/', '!') + '@@' +
+                   branch.replace('/', '!'))
+        return (repo, branch, os.path.join(site.pindir, 'git', repodir))
+
+    @classmethod
+    def fetch_directories(cls, site):
+        GitDirectory._fetchers[site] = GitFetcher(site)
+
+    def read_directories(self):
+        # A repository that failed to fetch has already been reported
+        if os.path.isdir(self.get_source_path()):
+            super().read_directories()
+
+    def read_pages(self):
+        if os.path.isdir(self.get_source_path()):
+            super().read_pages()
+
     def get_source_path(self):
         return os.path.join(self.absrepodir,
                             self.site.config.get('git_directory', self.path) or '')
@@ -16,7 +16,6 @@
 
 import copy
 import os
-import subprocess
 
 from lxml import etree
 
@@ -31,6 +30,49 @@ NS_MAP = {
     'cache': 'http://projectmallard.org/cache/1.0/'
 }
 
+_string_value = etree.XPath('string(.)')
+
+_CACHE_TAGS = (MAL_NS + 'section', MAL_NS + 'info', MAL_NS + 'title')
+
+# Which info titles and descs to use for each hint, in order
+_TITLE_KEYS = {None: ('text', 'page'),
+               'search': ('search', 'text-search', 'text', 'page')}
+_DESC_KEYS = {None: ('text', 'plain'),
+              'search': ('search', 'text-search', 'text', 'plain')}
+
+def _get_info_key(node):
+    ntype = node.get('type')
+    if ntype == 'search':
+        return 'search'
+    if ntype == 'text':
+        if node.get('role') == 'search':
+            return 'text-search'
+        if node.get('role') is None:
+            return 'text'
+        return None
+    if ntype is None:
+        return 'plain'
+    return None
+
+def iter_text(node):
+    # Yields the text inside node, leaving out the contents of info
+    # elements. This walks the tree without recursion.
+    depth = 0
+    infodepth = 0
+    for event, el in etree.iterwalk(node, events=('start', 'end')):
+        if event == 'start':
+            if depth > 0 and infodepth == 0 and el.text is not None:
+                yield el.text
+            if el.tag == MAL_NS + 'info':
+                infodepth += 1
+            depth += 1
+        else:
+            depth -= 1
+            if el.tag == MAL_NS + 'info':
+                infodepth -= 1
+            if depth > 0 and infodepth == 0 and el.tail is not None:
+                yield el.tail
+
 class MallardPage(pintail.site.Page,
                   pintail.site.ToolsProvider,
                   pintail.site.CssProvider,
@@ -40,22 +82,27 @@ class MallardPage(pintail.site.Page,
 
     def __init__(self, directory, source_file):
         pintail.site.Page.__init__(self, directory, source_file)
-        self.stage_page()
-        self._tree = etree.parse(self.get_stage_path())
-        etree.XInclude()(self._tree.getroot())
+        self._tree = self.stage_page()
         self._mallard_page_id = self._tree.getroot().get('id')
-        self._langtrees = {}
+        self._langs = set()
         self._notlangs = set()
+        self.site.tree_cache.hold_page(self)
 
     def _get_tree(self, lang=None):
+        if self._tree is None:
+            self._tree = etree.parse(self.get_stage_path())
+            self._tree.xinclude()
+        self.site.tree_cache.hold_page(self)
         if lang is None or lang in self._notlangs:
             return self._tree
-        if lang in self._langtrees:
-            return self._langtrees[lang]
-        if self.site.translate_page(self, lang):
-            return etree.parse(self.get_stage_path(lang))
-        self._notlangs.add(lang)
-        return self._tree
+        if lang not in self._langs:
+            if not self.site.translate_page(self, lang):
+                self._notlangs.add(lang)
+                return self._tree
+            # The translation may have been rewritten since we last saw it.
+            self.site.tree_cache.discard(self.get_stage_path(lang))
+            self._langs.add(lang)
+        return self.site.tree_cache.get_tree(self.get_stage_path(lang))
 
     @property
     def page_id(self):
@@ -67,57 +114,50 @@ class MallardPage(pintail.site.Page,
 
     @classmethod
     def build_tools(cls, site):
+        # The stylesheets may have changed, so compile them again
+        MallardPage._html_transform = None
         mal2html = os.path.join(site.yelp_xsl_path, 'xslt', 'mallard', 'html', 'mal2html.xsl')
 
-        fd = open(os.path.join(site.tools_path, 'pintail-html-mallard-local.xsl'), 'w')
-        fd.write('<xsl:stylesheet' +
-                 ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
-                 ' version="1.0">\n' +
-                 '<xsl:import href="pintail-html-mallard.xsl"/>\n' +
-                 '<xsl:param name="mal.link.extension" select="$pintail.extension.link"/>\n')
-        for xsl in site.get_custom_xsl():
-            fd.write('<xsl:include href="%s"/>\n' % xsl)
-        fd.write('</xsl:stylesheet>')
-        fd.close()
-
-        fd = open(os.path.join(site.tools_path, 'pintail-html-mallard.xsl'), 'w')
-        fd.write(('<xsl:stylesheet' +
-                  ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
-                  ' version="1.0">\n' +
-                  '<xsl:import href="%s"/>\n' +
-                  '<xsl:include href="%s"/>\n' +
-                  '</xsl:stylesheet>\n')
-                 % (mal2html, 'pintail-html.xsl'))
-        fd.close()
+        site._write_tools_file('pintail-html-mallard-local.xsl',
+                               '<xsl:stylesheet' +
+                               ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
+                               ' version="1.0">\n' +
+                               '<xsl:import href="pintail-html-mallard.xsl"/>\n' +
+                               '<xsl:param name="mal.link.extension" select="$pintail.extension.link"/>\n' +
+                               ''.join(['<xsl:include href="%s"/>\n' % xsl
+                                        for xsl in site.get_custom_xsl()]) +
+                               '</xsl:stylesheet>')
+
+        site._write_tools_file('pintail-html-mallard.xsl',
+                               ('<xsl:stylesheet' +
+                                ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
+                                ' version="1.0">\n' +
+                                '<xsl:import href="%s"/>\n' +
+                                '<xsl:include href="%s"/>\n' +
+                                '</xsl:stylesheet>\n')
+                               % (mal2html, 'pintail-html.xsl'))
 
     @classmethod
     def build_css(cls, site):
         xslpath = os.path.join(site.yelp_xsl_path, 'xslt')
 
-        pintail.site.Site._makedirs(site.tools_path)
-        cssxsl = os.path.join(site.tools_path, 'pintail-css-mallard.xsl')
-        fd = open(cssxsl, 'w')
-        fd.writelines([
+        xsl = ''.join([
             '<xsl:stylesheet',
             ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"',
-            ' xmlns:exsl="http://exslt.org/common"',
             ' xmlns:cache="http://projectmallard.org/cache/1.0/"',
             ' xmlns:mal="http://projectmallard.org/1.0/"',
-            ' extension-element-prefixes="exsl"',
             ' version="1.0">\n',
             '<xsl:import href="' + xslpath + '/common/l10n.xsl"/>\n',
             '<xsl:import href="' + xslpath + '/common/color.xsl"/>\n',
             '<xsl:import href="' + xslpath + '/common/icons.xsl"/>\n',
             '<xsl:import href="' + xslpath + '/common/html.xsl"/>\n',
-            '<xsl:import href="' + xslpath + '/mallard/html/mal2html-page.xsl"/>\n'
-            ])
-        fd.write('<xsl:import href="%s"/>\n' % 'pintail-html.xsl')
-        for xsl in site.get_custom_xsl():
-            fd.write('<xsl:include href="%s"/>\n' % xsl)
-        fd.writelines([
+            '<xsl:import href="' + xslpath + '/mallard/html/mal2html-page.xsl"/>\n',
+            '<xsl:import href="%s"/>\n' % 'pintail-html.xsl'
+            ] + [
+            '<xsl:include href="%s"/>\n' % custom for custom in site.get_custom_xsl()
+            ] + [
             '<xsl:output method="text"/>\n',
             '<xsl:param name="id"/>\n',
-            '<xsl:param name="out"/>\n',
             '<xsl:template match="/">\n',
             '<xsl:for-each select="/cache:cache/mal:page[@id=$id]">\n',
             '<xsl:variable name="locale">\n',
@@ -130,47 +170,87 @@ class MallardPage(pintail.site.Page,
             '  </xsl:otherwise>\n',
             ' </xsl:choose>\n',
             '</xsl:variable>\n',
-            '<exsl:document href="{$out}" method="text">\n',
-            ' <xsl:for-each select="document(@cache:href)">\n',
-            '  <xsl:call-template name="html.css.content"/>\n',
-            ' </xsl:for-each>\n',
-            '</exsl:document>\n',
+            '<xsl:for-each select="document(@cache:href)">\n',
+            ' <xsl:call-template name="html.css.content"/>\n',
+            '</xsl:for-each>\n',
             '</xsl:for-each>\n',
             '</xsl:template>\n'
             '</xsl:stylesheet>\n'
             ])
-        fd.close()
 
-        seenlangs = []
+        # Find one page for each locale without building whole trees.
+        # Cache files are only parsed for locales that get rendered.
+        caches = {}
+        def _get_cache(cache):
+            if cache not in caches:
+                caches[cache] = etree.parse(cache)
+            return caches[cache]
+        docs = []
+        seenlangs = set()
         for lang in [None] + site.get_langs():
             cache = site.get_cache_path(lang)
-            for page in etree.parse(cache).xpath('/cache:cache/mal:page', namespaces=NS_MAP):
-                lang = page.get(XML_NS + 'lang', 'C')
-                if lang in seenlangs:
-                    continue
-                seenlangs.append(lang)
-                cssfile = 'pintail-mallard-' + lang + '.css'
-                csspath = os.path.join(site.target_path, cssfile)
-                site.log('CSS', '/' + cssfile)
-                subprocess.call(['xsltproc',
-                                 '-o', site.target_path,
-                                 '--stringparam', 'id', page.get('id'),
-                                 '--stringparam', 'out', csspath,
-                                 cssxsl, cache])
-                custom_css = site.config.get('custom_css')
-                if custom_css is not None:
-                    custom_css = os.path.join(site.topdir, custom_css)
-                    fd = open(csspath, 'a')
-                    fd.write(open(custom_css).read())
-                    fd.close()
+            for event, page in etree.iterparse(cache, tag=MAL_NS + 'page'):
+                locale = page.get(XML_NS + 'lang', 'C')
+                if locale not in seenlangs:
+                    seenlangs.add(locale)
+                    docs.append((locale, lambda cache=cache: _get_cache(cache),
+                                 {'id': page.get('id')}))
+                page.clear()
+        site.build_css_files('mallard', xsl, docs)
+
+    def get_dependencies(self):
+        source = self.get_source_path()
+        return [source] + self.site.manifest.get_xinclude_dependencies(source)
 
     def stage_page(self):
+        # Returns the staged tree, so the page doesn't have to parse the
+        # staged file again.
         pintail.site.Site._makedirs(self.directory.get_stage_path())
-        subprocess.call(['xmllint', '--xinclude',
-                         '-o', self.get_stage_path(),
-                         self.get_source_path()])
+        tree = etree.parse(self.get_source_path())
+        tree.xinclude()
+        tree.write(self.get_stage_path(), xml_declaration=True, encoding='utf-8')
+        return tree
 
     def get_cache_data(self, lang=None):
+        # Built in the summary pass, along with everything else
+        page = etree.fromstring(self.get_summary(lang).cache_data)
+        page.tail = '\n'
+        return page
+
+    def _get_cache_node(self, node):
+        ret = etree.Element(node.tag)
+        ret.text = '\n'
+        ret.tail = '\n'
+        for attr in node.keys():
+            if attr != 'id':
+                ret.set(attr, node.get(attr))
+        if node.tag == MAL_NS + 'page':
+            ret.set('id', self.site_id)
+        elif node.get('id', None) is not None:
+            ret.set('id', self.site_id + '#' + node.get('id'))
+        ret.set(SITE_NS + 'dir', self.directory.path)
+        return ret
+
+    def _get_cache_info(self, node):
+        # Copies an info element, making relative xrefs absolute
+        info = etree.Element(node.tag)
+        for infochild in node:
+            if infochild.tag == MAL_NS + 'link':
+                xref = infochild.get('xref', None)
+                if xref is None or xref.startswith('/'):
+                    info.append(copy.deepcopy(infochild))
+                else:
+                    link = etree.Element(infochild.tag)
+                    link.set('xref', self.directory.path + xref)
+                    for attr in infochild.keys():
+                        if attr != 'xref':
+                            link.set(attr, infochild.get(attr))
+                    for linkchild in infochild:
+                        link.append(copy.deepcopy(linkchild))
+                    info.append(link)
+            else:
+                info.append(copy.deepcopy(infochild))
+        return info
         def _get_node_cache(node):
             ret = etree.Element(node.tag)
             ret.text = '\n'
@@ -227,83 +307,125 @@ class MallardPage(pintail.site.Page,
         MallardPage._html_transform(self._get_tree(lang), **args)
 
 
-    def get_media(self):
-        refs = set()
-        def _accumulate_refs(node):
-            src = node.get('src', None)
+    def summarize(self, lang=None):
+        root = self._get_tree(lang).getroot()
+        summary = pintail.site.PageSummary()
+
+        def _get_site_id(xref):
+            xref = xref.split('#')[0]
+            if xref.startswith('/'):
+                return xref
+            elif xref != '':
+                return self.directory.path + xref
+            return None
+
+        titles = {}
+        descs = {}
+        for child in root:
+            if child.tag == MAL_NS + 'title':
+                titles['page'] = child
+            elif child.tag == MAL_NS + 'info':
+                for info in child:
+                    if info.tag == MAL_NS + 'title':
+                        titles[_get_info_key(info)] = info
+                    elif info.tag == MAL_NS + 'desc':
+                        descs[_get_info_key(info)] = info
+                    elif info.tag == MAL_NS + 'keywords':
+                        summary.keywords = _string_value(info)
+                    elif info.tag == MAL_NS + 'link' and info.get('xref') is not None:
+                        xref = _get_site_id(info.get('xref'))
+                        if xref is None:
+                            continue
+                        if info.get('type') == 'guide':
+                            summary.guides.add(xref)
+                        elif info.get('type') == 'topic':
+                            summary.topics.add(xref)
+        for hint in _TITLE_KEYS:
+            for key in _TITLE_KEYS[hint]:
+                if key in titles:
+                    summary.titles[hint] = _string_value(titles[key])
+                    break
+        for hint in _DESC_KEYS:
+            for key in _DESC_KEYS[hint]:
+                if key in descs:
+                    summary.descs[hint] = _string_value(descs[key])
+                    break
+
+        # The cache data has an element for the page and for each section
+        # directly in it or in another section, each with copies of its
+        # info and title elements. They're built in document order.
+        cache = self._get_cache_node(root)
+        caches = {root: cache}
+        for node in root.iter(etree.Element):
+            if node.tag in _CACHE_TAGS and node is not root:
+                parent = caches.get(node.getparent())
+                if parent is not None:
+                    if node.tag == MAL_NS + 'section':
+                        caches[node] = self._get_cache_node(node)
+                        parent.append(caches[node])
+                    elif node.tag == MAL_NS + 'info':
+                        parent.append(self._get_cache_info(node))
+                    else:
+                        parent.append(copy.deepcopy(node))
+            src = node.get('src')
             if src is not None and ':' not in src and src != '#':
-                refs.add(src)
-            href = node.get('href', None)
+                summary.media.add(src)
+            href = node.get('href')
             if href is not None and ':' not in href:
-                refs.add(href)
-            for child in node:
-                _accumulate_refs(child)
-        _accumulate_refs(self._tree.getroot())
-        return refs
+                summary.media.add(href)
+            xref = node.get('xref')
+            if xref is not None:
+                xref = _get_site_id(xref)
+                if xref is not None:
+                    summary.links.add(xref)
+            if node.tag == MAL_NS + 'links':
+                if node.get('type') in ('site-subdirs', 'site:subdirs'):
+                    summary.subdirs_links = True
+            elif node.tag == MAL_NS + 'code':
+                if node.get('mime') is not None:
+                    summary.code_mimes.add(node.get('mime'))
+        cache.set(CACHE_NS + 'href', self.get_stage_path(lang))
+        summary.cache_data = etree.tostring(cache)
+        return summary
+
+    def get_media(self):
+        return self.get_summary().media
+
+    def get_links(self):
+        # Subdirectories can be added after this page is read, so links
+        # to their index pages are only found when they're asked for
+        summary = self.get_summary()
+        if not summary.subdirs_links:
+            return summary.links
+        return summary.links | set(subdir.path + 'index'
+                                   for subdir in self.directory.directories)
+
+    def get_guide_links(self):
+        return self.get_summary().guides
+
+    def get_topic_links(self):
+        return self.get_summary().topics
+
+    def get_code_mimes(self):
+        return self.get_summary().code_mimes
 
     def get_title(self, hint=None, lang=None):
-        tree = self._get_tree(lang)
-        res = []
-        if hint == 'search':
-            res = tree.xpath('/mal:page/mal:info/mal:title[@type="search"]',
-                             namespaces=NS_MAP)
-            if len(res) == 0:
-                res = tree.xpath('/mal:page/mal:info/mal:title[@type="text"][@role="search"]',
-                                 namespaces=NS_MAP)
-        if len(res) == 0:
-            res = tree.xpath('/mal:page/mal:info/mal:title[@type="text"][not(@role)]',
-                             namespaces=NS_MAP)
-        if len(res) == 0:
-            res = tree.xpath('/mal:page/mal:title', namespaces=NS_MAP)
-        if len(res) == 0:
-            return ''
-        else:
-            return res[-1].xpath('string(.)')
+        return self.get_summary(lang).get_title(hint)
 
     def get_desc(self, hint=None, lang=None):
-        tree = self._get_tree(lang)
-        res = []
-        if hint == 'search':
-            res = tree.xpath('/mal:page/mal:info/mal:desc[@type="search"]',
-                             namespaces=NS_MAP)
-            if len(res) == 0:
-                res = tree.xpath('/mal:page/mal:info/mal:desc[@type="text"][@role="search"]',
-                                 namespaces=NS_MAP)
-        if len(res) == 0:
-            res = tree.xpath('/mal:page/mal:info/mal:desc[@type="text"][not(@role)]',
-                             namespaces=NS_MAP)
-        if len(res) == 0:
-            res = tree.xpath('/mal:page/mal:info/mal:desc[not(@type)]', namespaces=NS_MAP)
-        if len(res) == 0:
-            return ''
-        else:
-            return res[-1].xpath('string(.)')
+        return self.get_summary(lang).get_desc(hint)
 
     def get_keywords(self, hint=None, lang=None):
-        tree = self._get_tree(lang)
-        res = tree.xpath('/mal:page/mal:info/mal:keywords', namespaces=NS_MAP)
-        if len(res) == 0:
-            return ''
-        else:
-            return res[-1].xpath('string(.)')
+        return self.get_summary(lang).keywords
 
     def get_content(self, hint=None, lang=None):
         # FIXME: could be good to have smarter block/inline handling, conditional
         # processing, correct block fallback. Probably should just have a mal2text
         # in yelp-xsl.
-        tree = self._get_tree(lang)
-        def _accumulate_text(node):
-            ret = ''
-            for child in node:
-                if not isinstance(child.tag, str):
-                    continue
-                if node.tag == MAL_NS + 'info':
-                    continue
-                ret += child.text or ''
-                ret += _accumulate_text(child)
-                ret += child.tail or ''
-            return ret
-        return _accumulate_text(tree.getroot())
+        return ''.join(self.iter_content(hint=hint, lang=lang))
+
+    def iter_content(self, hint=None, lang=None):
+        return iter_text(self._get_tree(lang).getroot())
 
     @classmethod
     def get_xsl_params(cls, output, obj, lang=None):
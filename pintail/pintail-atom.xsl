@@ -30,7 +30,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
                 exclude-result-prefixes="mal cache site html atom str exsl"
                 version="1.0">
 
-<xsl:import href="site2html.xsl"/>
+<xsl:import href="pintail-html.xsl"/>
 
 <xsl:param name="feed.exclude_styles" select="''"/>
 
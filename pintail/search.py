@@ -14,17 +14,99 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
+import gzip
+import json
+import os
+import re
+import threading
+import time
+
 import pintail.site
 
+def _extract_job(site, path, index, lang):
+    page = site.get_directory(path).pages[index]
+    return (page.get_title(hint='search', lang=lang),
+            page.get_desc(hint='search', lang=lang),
+            page.get_keywords(hint='search', lang=lang),
+            page.get_content(hint='search', lang=lang))
+
+
+class SearchDocument:
+    def __init__(self, page, lang, title, desc, keywords, content):
+        self.page = page
+        self.lang = lang
+        self.title = title
+        self.desc = desc
+        self.keywords = keywords
+        self.content = content
+
+    @property
+    def domains(self):
+        return self.page.get_search_domains()
+
+
 class SearchProvider(pintail.site.Extendable):
+    # Providers can either override index_page, which is called once for
+    # each page and language, or index_pages, which is called with lists
+    # of SearchDocument objects. For index_pages, the text of each page
+    # is extracted in worker processes (see --jobs), and batches of up
+    # to search_batch_size documents from each directory are handed to
+    # up to search_flush_jobs threads at once.
     def __init__(self, site):
         self.site = site
 
+    def get_batch_size(self):
+        try:
+            return max(int(self.site.config.get('search_batch_size') or 100), 1)
+        except ValueError:
+            return 100
+
+    def get_flush_jobs(self):
+        try:
+            return max(int(self.site.config.get('search_flush_jobs') or 4), 1)
+        except ValueError:
+            return 4
+
     def index_site(self):
-        for subdir in self.site.root.iter_directories():
-            self.index_directory(subdir)
+        directories = list(self.site.root.iter_directories())
+        if (type(self).index_pages is SearchProvider.index_pages or
+            type(self).index_directory is not SearchProvider.index_directory):
+            for subdir in directories:
+                self.index_directory(subdir)
+            return
+        # Text for the whole site is extracted with one map_jobs call, so
+        # worker processes are only started once. Each directory takes its
+        # share of the results, in order.
+        tasks = []
+        for subdir in directories:
+            tasks.extend(self._get_extract_tasks(subdir,
+                                                 list(self.iter_documents(subdir))))
+        results = iter(self.site.map_jobs(_extract_job, tasks, chunksize=16))
+        for subdir in directories:
+            self.index_directory(subdir, results)
 
-    def index_directory(self, directory):
+    def index_directory(self, directory, results=None):
+        documents = list(self.iter_documents(directory))
+        if type(self).index_pages is SearchProvider.index_pages:
+            for page, lang in documents:
+                self.index_page(page, lang=lang)
+            return
+        if results is None:
+            results = self.site.map_jobs(_extract_job,
+                                         self._get_extract_tasks(directory, documents),
+                                         chunksize=16)
+        self.index_documents(documents, results)
+
+    def _get_extract_tasks(self, directory, documents):
+        # Worker processes find each page by its place in the directory
+        positions = {id(page): i for i, page in enumerate(directory.pages)}
+        return [(directory.path, positions[id(page)], lang)
+                for page, lang in documents]
+
+    def iter_documents(self, directory):
+        # Yields (page, lang) for each document to index in directory
         langs = [None]
         if not self.site.get_filter(directory):
             return
@@ -39,7 +121,180 @@ class SearchProvider(pintail.site.Extendable):
             if dms[0] == 'none':
                 continue
             for lc in langs:
-                self.index_page(page, lang=lc)
+                yield (page, lc)
+
+    def index_documents(self, documents, results):
+        # Hands (page, lang) documents and their extracted text to
+        # index_pages in batches, on a few threads at once. Only one
+        # result is taken from results for each document.
+        batchsize = self.get_batch_size()
+        maxpending = self.get_flush_jobs()
+        pending = []
+        batch = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxpending) as executor:
+            for (page, lang), text in zip(documents, results):
+                batch.append(SearchDocument(page, lang, *text))
+                if len(batch) < batchsize:
+                    continue
+                # Don't get too far ahead of the backend
+                if len(pending) >= maxpending:
+                    pending.pop(0).result()
+                pending.append(executor.submit(self.index_pages, batch))
+                batch = []
+            if len(batch) > 0:
+                pending.append(executor.submit(self.index_pages, batch))
+            for future in pending:
+                future.result()
+
+    def index_pages(self, batch):
+        for doc in batch:
+            self.index_page(doc.page, lang=doc.lang)
 
     def index_page(self, page, lang=None):
         pass
+
+
+class StubSearchProvider(SearchProvider):
+    # Keeps documents in memory, for measuring indexing throughput
+    # without a real backend. search_stub_latency adds a delay in
+    # seconds to each batch, like a round trip to a server.
+    def __init__(self, site):
+        SearchProvider.__init__(self, site)
+        self.documents = []
+        self.batches = 0
+        try:
+            self.latency = float(site.config.get('search_stub_latency') or 0)
+        except ValueError:
+            self.latency = 0
+
+    def index_site(self):
+        start = time.time()
+        SearchProvider.index_site(self)
+        elapsed = time.time() - start
+        self.site.log('SEARCH', '%i documents in %i batches in %.2fs (%.1f/s)' %
+                      (len(self.documents), self.batches, elapsed,
+                       len(self.documents) / elapsed if elapsed > 0 else 0))
+
+    def index_pages(self, batch):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.batches += 1
+        self.documents.extend(batch)
+
+
+_token_re = re.compile(r'\w+')
+
+def iter_tokens(chunks):
+    # Tokenizes a stream of text, like Page.iter_content, keeping words
+    # that are split across chunks together
+    partial = ''
+    for chunk in chunks:
+        text = partial + chunk.lower()
+        tokens = _token_re.findall(text)
+        partial = ''
+        if len(tokens) > 0 and _token_re.match(text, len(text) - 1):
+            partial = tokens.pop()
+        for token in tokens:
+            if len(token) > 1 or token.isdigit():
+                yield token
+    if len(partial) > 1 or partial.isdigit():
+        yield partial
+
+def tokenize(text):
+    return iter_tokens([text])
+
+
+class SearchIndex:
+    # An inverted index for one search domain and language. Terms map
+    # to flat lists of document numbers and weights, with each document
+    # number stored as the difference from the one before it. The whole
+    # thing is written as gzipped JSON for client-side lookup.
+    weights = (('title', 8), ('keywords', 4), ('desc', 2), ('content', 1))
+
+    def __init__(self):
+        self._docs = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    @classmethod
+    def get_term_weights(cls, **fields):
+        # Fields can be strings or iterables of strings
+        counts = collections.Counter()
+        for field, weight in cls.weights:
+            text = fields.get(field) or ''
+            if isinstance(text, str):
+                text = [text]
+            for token in iter_tokens(text):
+                counts[token] += weight
+        return counts
+
+    def add_document(self, url, title, desc, counts):
+        with self._lock:
+            self._docs.append((url, title, desc, counts))
+
+    def get_data(self):
+        # Sort so that the same pages always give the same bytes
+        docs = sorted(self._docs, key=lambda doc: doc[0])
+        postings = collections.defaultdict(list)
+        for docid, doc in enumerate(docs):
+            for term, weight in doc[3].items():
+                postings[term].append((docid, weight))
+        terms = {}
+        for term in sorted(postings):
+            flat = []
+            last = 0
+            for docid, weight in postings[term]:
+                flat.append(docid - last)
+                flat.append(weight)
+                last = docid
+            terms[term] = flat
+        data = json.dumps({'version': 1,
+                           'docs': [[doc[0], doc[1], doc[2]] for doc in docs],
+                           'terms': terms},
+                          ensure_ascii=False, separators=(',', ':'))
+        return gzip.compress(data.encode('utf-8'), compresslevel=6, mtime=0)
+
+
+class StaticSearchProvider(SearchProvider):
+    # Writes one SearchIndex for each search domain and language into
+    # the built site, at Site.get_search_target_path. Indexes are only
+    # written on full builds, because a filtered build only sees some
+    # of the pages in each domain.
+    def __init__(self, site):
+        SearchProvider.__init__(self, site)
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def index_site(self):
+        self._indexes = {}
+        SearchProvider.index_site(self)
+        if not self.site.is_filtered():
+            self.write_indexes()
+
+    def index_pages(self, batch):
+        for doc in batch:
+            counts = SearchIndex.get_term_weights(title=doc.title, desc=doc.desc,
+                                                  keywords=doc.keywords,
+                                                  content=doc.content)
+            for domain in doc.domains:
+                with self._lock:
+                    index = self._indexes.get((domain, doc.lang))
+                    if index is None:
+                        index = SearchIndex()
+                        self._indexes[(domain, doc.lang)] = index
+                index.add_document(doc.page.site_path, doc.title, doc.desc, counts)
+
+    def write_indexes(self):
+        for domain, lang in sorted(self._indexes, key=lambda key: (key[0], key[1] or '')):
+            path = self.site.get_search_target_path(domain, lang)
+            data = self._indexes[(domain, lang)].get_data()
+            if os.path.exists(path):
+                with open(path, 'rb') as fd:
+                    if fd.read() == data:
+                        continue
+            self.site.log('SEARCH', path)
+            pintail.site.Site._makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fd:
+                fd.write(data)
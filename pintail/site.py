@@ -15,12 +15,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import codecs
+import collections
+import concurrent.futures
 import configparser
 import copy
 import datetime
 import glob
+import hashlib
 import importlib
+import itertools
+import json
 import logging
+import multiprocessing
 import os
 import shutil
 import subprocess
@@ -32,10 +38,17 @@ MAL_NS = '{http://projectmallard.org/1.0/}'
 CACHE_NS = '{http://projectmallard.org/cache/1.0/}'
 SITE_NS = '{http://projectmallard.org/site/1.0/}'
 XML_NS = '{http://www.w3.org/XML/1998/namespace}'
+XI_NS = '{http://www.w3.org/2001/XInclude}'
 NS_MAP = {
     'mal': 'http://projectmallard.org/1.0/',
     'cache': 'http://projectmallard.org/cache/1.0/'
 }
+CACHE_NS_MAP = {
+    None: 'http://projectmallard.org/1.0/',
+    'cache': 'http://projectmallard.org/cache/1.0/',
+    'site': 'http://projectmallard.org/site/1.0/',
+    'pintail': 'http://pintail.io/'
+}
 
 
 class DuplicatePageException(Exception):
@@ -44,7 +57,33 @@ class DuplicatePageException(Exception):
         self.parser = directory
 
 
+# The site that jobs run by Site.map_jobs work on. Worker processes are
+# forked, so they inherit this from the parent.
+_job_site = None
+
+def _run_job(func, args):
+    return func(_job_site, *args)
+
+def _load_pages_job(site, path, name):
+    return site._loading_pages[path].load_pages(name)
+
+def _build_html_job(site, index):
+    page, lang, digest = site._html_jobs[index]
+    page.build_html(lang)
+    return os.getpid()
+
+
 class Extendable:
+    # Subclasses that define each hook, by base class and hook name.
+    # Site.__init__ fills this in once plugins are imported, so hot paths
+    # don't walk the class hierarchy every time they call a hook.
+    _hooks = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # A class defined later could implement any hook
+        Extendable._hooks.clear()
+
     @classmethod
     def iter_subclasses(cls, filter=None):
         for cls in cls.__subclasses__():
@@ -52,6 +91,15 @@ class Extendable:
                 yield cls
             yield from cls.iter_subclasses(filter)
 
+    @classmethod
+    def get_hooks(cls, filter=None):
+        # The same classes as iter_subclasses, looked up only once
+        hooks = Extendable._hooks.get((cls, filter))
+        if hooks is None:
+            hooks = tuple(cls.iter_subclasses(filter))
+            Extendable._hooks[(cls, filter)] = hooks
+        return hooks
+
 
 class ToolsProvider(Extendable):
     @classmethod
@@ -76,6 +124,19 @@ class XslProvider(Extendable):
 
     @classmethod
     def get_all_xsl_params(cls, output, obj, lang=None):
+        if isinstance(obj, Page):
+            # Everything but the source file is the same for all pages
+            # in a directory
+            params = dict(obj.site.get_xsl_param_frame(output, obj.directory, lang))
+            params['pintail.source.file'] = obj.source_file
+        else:
+            params = dict(cls._get_xsl_params_for(output, obj, lang))
+        for c in XslProvider.get_hooks('get_xsl_params'):
+            params.update(c.get_xsl_params(output, obj, lang))
+        return list(params.items())
+
+    @classmethod
+    def _get_xsl_params_for(cls, output, obj, lang=None):
         ret = []
         if output == 'html' and hasattr(obj, 'site'):
             html_extension = obj.site.config.get('html_extension') or '.html'
@@ -99,11 +160,12 @@ class XslProvider(Extendable):
                 ret.append(('html.output.prefix', obj.directory.get_target_path(lang)))
         if hasattr(obj, 'source_file'):
             ret.append(('pintail.source.file', obj.source_file))
-        now = datetime.datetime.now()
+        if hasattr(obj, 'site'):
+            now = obj.site.build_time
+        else:
+            now = datetime.datetime.now()
         ret.append(('pintail.date', now.strftime('%Y-%m-%d')))
         ret.append(('pintail.time', now.strftime('%T')))
-        for c in XslProvider.iter_subclasses('get_xsl_params'):
-            ret.extend(c.get_xsl_params(output, obj, lang))
         return ret
 
     @classmethod
@@ -116,6 +178,37 @@ class XslProvider(Extendable):
         return ret
 
 
+class PageSummary:
+    # Everything the build needs from one page tree in one language,
+    # collected by Page.summarize in a single pass over the tree. Text
+    # content is left out; get_content extracts it only when asked.
+    def __init__(self):
+        self.media = set()
+        self.links = set()
+        # True if the page links to the index pages of its subdirectories
+        self.subdirs_links = False
+        # Pages the page's info names as its guides, and as its topics
+        self.guides = set()
+        self.topics = set()
+        # Serialized cache data, for page types that build it here
+        self.cache_data = None
+        self.code_mimes = set()
+        # Titles and descriptions by hint, with None for the default
+        self.titles = {}
+        self.descs = {}
+        self.keywords = ''
+
+    def get_title(self, hint=None):
+        if hint in self.titles:
+            return self.titles[hint]
+        return self.titles.get(None, '')
+
+    def get_desc(self, hint=None):
+        if hint in self.descs:
+            return self.descs[hint]
+        return self.descs.get(None, '')
+
+
 class Page(Extendable):
     def __init__(self, directory, source_file):
         self.directory = directory
@@ -123,6 +216,14 @@ class Page(Extendable):
 
         self._source_file = source_file
         self._search_domains = None
+        self._summaries = {}
+        # Page types that parse a tree keep it here, and keep the page's
+        # cache data serialized once the tree is released
+        self._tree = None
+        self._cache_data = None
+        # Set by page types that convert a source file when staging it, so
+        # the manifest records only staged files that were really made.
+        self._staged = False
 
     @property
     def page_id(self):
@@ -147,6 +248,14 @@ class Page(Extendable):
     def get_source_path(self):
         return os.path.join(self.directory.get_source_path(), self.source_file)
 
+    def get_dependencies(self):
+        return [self.get_source_path()]
+
+    def is_stage_current(self):
+        # True if the staged file was made from the current sources
+        return self.site.manifest.is_stage_current(self.get_stage_path(),
+                                                   self.get_dependencies())
+
     @property
     def stage_file(self):
         return self.source_file
@@ -175,6 +284,34 @@ class Page(Extendable):
     def get_media(self):
         return []
 
+    def get_links(self):
+        # The site ids of other pages whose cache data this page shows
+        return set()
+
+    def get_guide_links(self):
+        # The site ids of pages this page names as its guides. Link
+        # trails show the guides of those pages too.
+        return set()
+
+    def get_topic_links(self):
+        # The site ids of pages this page names as its topics
+        return set()
+
+    def get_code_mimes(self):
+        # The mime types of code blocks, used to pick syntax brushes
+        return set()
+
+    def get_summary(self, lang=None):
+        # Summaries are made once for each language and kept, so phases
+        # that need titles, media, or links don't walk the tree again.
+        if lang not in self._summaries:
+            self._summaries[lang] = self.summarize(lang)
+        return self._summaries[lang]
+
+    def summarize(self, lang=None):
+        # Page types that can summarize their trees return a PageSummary
+        return None
+
     def get_title(self, hint=None, lang=None):
         return ''
 
@@ -187,9 +324,47 @@ class Page(Extendable):
     def get_content(self, hint=None, lang=None):
         return ''
 
+    def iter_content(self, hint=None, lang=None):
+        # Yields the text of get_content in pieces, for callers like search
+        # backends that can take a stream instead of one long string
+        yield self.get_content(hint=hint, lang=lang)
+
     def build_html(self, lang=None):
         return
 
+    def _compact(self):
+        # Keep what's needed to read the site without the tree
+        summary = self.get_summary()
+        self.get_media()
+        if summary is not None and summary.cache_data is not None:
+            # Kept with the summary already
+            return
+        if self._cache_data is None:
+            cache_data = self.get_cache_data()
+            if cache_data is not None:
+                self._cache_data = etree.tostring(cache_data)
+
+    def release_tree(self):
+        # Drop the parsed tree to save memory, keeping what's needed to
+        # read the site. The tree is parsed again if it's needed.
+        if self._tree is not None:
+            self._compact()
+            self._tree = None
+            self._summaries = {None: self._summaries[None]}
+
+    def __getstate__(self):
+        # Pages are pickled to send them back from worker processes when
+        # reading pages in parallel. Directory.add_pages sets directory
+        # and site again. Trees can't be pickled, so the staged file is
+        # parsed again if anything else is needed.
+        if self._tree is not None:
+            self._compact()
+        state = self.__dict__.copy()
+        state['directory'] = None
+        state['site'] = None
+        state['_tree'] = None
+        return state
+
     def get_search_domains(self):
         if self._search_domains is not None:
             return self._search_domains
@@ -251,6 +426,12 @@ class Directory(Extendable):
     def is_special_path(cls, site, path):
         return False
 
+    @classmethod
+    def fetch_directories(cls, site):
+        # Called before any directories are read, so directory types can
+        # start fetching their sources in the background.
+        pass
+
     def read_directories(self):
         for name in os.listdir(self.get_source_path()):
             if os.path.isdir(os.path.join(self.get_source_path(), name)):
@@ -258,7 +439,7 @@ class Directory(Extendable):
                 if self.site.get_ignore_directory(subpath):
                     continue
                 subdir = None
-                for cls in Directory.iter_subclasses():
+                for cls in Directory.get_hooks():
                     if cls.is_special_path(self.site, subpath):
                         subdir = cls(self.site, subpath, parent=self)
                         break
@@ -267,25 +448,72 @@ class Directory(Extendable):
                 self.directories.append(subdir)
 
     def read_pages(self):
+        if self.site._pending_pages is not None:
+            # Site.read_directories will load these in worker processes
+            self.site._pending_pages[self.path] = self
+            return
+        self.stage_pages()
         by_page_id = {}
-        for cls in Page.iter_subclasses('get_pages_dir'):
-            for page in cls.get_pages_dir(self):
-                if page.page_id in by_page_id:
-                    raise DuplicatePageException(self,
-                                                 'Duplicate page id ' +
-                                                 page.page_id)
-                by_page_id[page.page_id] = page
-                self.pages.append(page)
-        for name in os.listdir(self.get_source_path()):
-            if os.path.isfile(os.path.join(self.get_source_path(), name)):
-                for cls in Page.iter_subclasses('get_pages'):
-                    for page in cls.get_pages(self, name):
-                        if page.page_id in by_page_id:
-                            raise DuplicatePageException(self,
-                                                         'Duplicate page id ' +
-                                                         page.page_id)
-                        by_page_id[page.page_id] = page
-                        self.pages.append(page)
+        for name in [None] + self.get_page_files():
+            self.add_pages(self.load_pages(name), by_page_id)
+
+    def stage_pages(self):
+        # Lets page types stage all their files in a directory at once,
+        # before the pages are loaded one at a time.
+        for cls in Page.get_hooks('stage_directory'):
+            cls.stage_directory(self)
+
+    def get_page_files(self):
+        return [name for name in os.listdir(self.get_source_path())
+                if os.path.isfile(os.path.join(self.get_source_path(), name))]
+
+    def load_pages(self, name=None):
+        # Without a file name, this gets pages for the whole directory.
+        ret = []
+        if name is None:
+            for cls in Page.get_hooks('get_pages_dir'):
+                ret.extend(cls.get_pages_dir(self))
+        else:
+            for cls in Page.get_hooks('get_pages'):
+                ret.extend(cls.get_pages(self, name))
+        return ret
+
+    def reload_pages(self, name):
+        # Stage the pages from one file again, keeping their place in
+        # the list of pages. Pages from a new file go at the end. The new
+        # list is only used if it has no duplicate page ids.
+        pages = []
+        if os.path.isfile(os.path.join(self.get_source_path(), name)):
+            pages = self.load_pages(name)
+        newpages = []
+        by_page_id = {}
+        for page in self.pages:
+            if page.source_file != name:
+                self.add_pages([page], by_page_id, newpages)
+            elif len(pages) > 0:
+                self.add_pages(pages, by_page_id, newpages)
+                pages = []
+        self.add_pages(pages, by_page_id, newpages)
+        for page in self.pages:
+            if page.source_file == name:
+                self.site.tree_cache.discard_page(page)
+        self.pages = newpages
+
+    def add_pages(self, pages, by_page_id, pagelist=None):
+        if pagelist is None:
+            pagelist = self.pages
+        for page in pages:
+            page.directory = self
+            page.site = self.site
+            if page._staged:
+                self.site.manifest.set_stage_current(page.get_stage_path(),
+                                                     page.get_dependencies())
+            if page.page_id in by_page_id:
+                raise DuplicatePageException(self,
+                                             'Duplicate page id ' +
+                                             page.page_id)
+            by_page_id[page.page_id] = page
+            pagelist.append(page)
 
     def iter_directories(self):
         yield self
@@ -341,34 +569,52 @@ class Directory(Extendable):
                 Site._makedirs(self.get_target_path(lc))
 
     def build_html(self):
+        manifest = self.site.manifest
+        for page, lc, digest in self.iter_html_jobs():
+            page.build_html(lc)
+            manifest.set_record('html', Manifest.get_page_key(page, lc), digest)
+
+    def iter_html_jobs(self):
+        # Yields (page, lang, digest) for each page that needs building
         for subdir in self.directories:
-            subdir.build_html()
+            yield from subdir.iter_html_jobs()
         if not self.site.get_filter(self):
             return
         self._maketargetdirs()
+        langs = [None]
+        if self.translation_provider is not None:
+            langs += self.translation_provider.get_directory_langs(self)
+        manifest = self.site.manifest
         for page in self.pages:
             if not self.site.get_filter(page):
                 continue
-            page.build_html()
-            if self.translation_provider is not None:
-                for lc in self.translation_provider.get_directory_langs(self):
-                    page.build_html(lc)
+            for lc in langs:
+                key = Manifest.get_page_key(page, lc)
+                digest = manifest.get_html_digest(page, lc)
+                if manifest.is_current('html', key, digest, page.get_target_path(lc)):
+                    continue
+                yield (page, lc, digest)
 
     def build_media(self):
+        self.site.sync_files('media', list(self.iter_media_jobs()),
+                             prune=(self is self.site.root))
+
+    def iter_media_jobs(self):
+        # Yields (source, target, label) for each media file used by
+        # pages in this directory and its subdirectories
         for subdir in self.directories:
-            subdir.build_media()
+            yield from subdir.iter_media_jobs()
         if not self.site.get_filter(self):
             return
-        self._maketargetdirs()
         media = set()
         for page in self.pages:
             if not self.site.get_filter(page):
                 continue
             media.update(page.get_media())
-        for fname in media:
-            langs = [None]
-            if self.translation_provider is not None:
-                langs += self.translation_provider.get_directory_langs(self)
+        langs = [None]
+        if self.translation_provider is not None:
+            langs += self.translation_provider.get_directory_langs(self)
+        for fname in sorted(media):
             for lc in langs:
                 if lc is not None:
                     tr = self.translation_provider.translate_media(self, fname, lc)
@@ -378,7 +624,7 @@ class Directory(Extendable):
                         # These have to be managed with extra_files for now
                         continue
                     source = os.path.join(self.get_stage_path(lc), fname)
-                    self.site.log('MEDIA', lc + ' ' + self.path + fname)
+                    label = lc + ' ' + self.path + fname
                 else:
                     if fname.startswith('/'):
                         source = os.path.join(self.site.topdir, fname[1:])
@@ -389,20 +635,20 @@ class Directory(Extendable):
                         source = os.path.join(self.get_stage_path(), fname)
                         if not os.path.exists(source):
                             source = os.path.join(self.get_source_path(), fname)
-                    self.site.log('MEDIA', self.path + fname)
-                target = self.site.get_media_target_path(self, fname, lc)
-                Site._makedirs(os.path.dirname(target))
-                try:
-                    shutil.copyfile(source, target)
-                except:
-                    self.site.logger.warn('Could not copy file %s' % fname)
+                    label = self.path + fname
+                yield (source, self.site.get_media_target_path(self, fname, lc), label)
 
     def build_files(self):
+        self.site.sync_files('files', list(self.iter_file_jobs()),
+                             prune=(self is self.site.root))
+
+    def iter_file_jobs(self):
+        # Yields (source, target, label) for each file matched by
+        # extra_files in this directory and its subdirectories
         for subdir in self.directories:
-            subdir.build_files()
+            yield from subdir.iter_file_jobs()
         if not self.site.get_filter(self):
             return
-        Site._makedirs(self.get_stage_path())
         globs = self.site.config.get('extra_files', self.path)
         if globs is not None:
             for glb in globs.split():
@@ -410,67 +656,31 @@ class Directory(Extendable):
                 # glob-like in it. Would be nice if glob() could take
                 # a base path that isn't glob-interpreted.
                 files = glob.glob(os.path.join(self.get_source_path(), glb))
-                for fname in files:
-                    self.site.log('FILE', self.path + os.path.basename(fname))
-                    shutil.copyfile(fname,
-                                    os.path.join(self.get_target_path(),
-                                                 os.path.basename(fname)))
+                for fname in sorted(files):
+                    yield (fname,
+                           os.path.join(self.get_target_path(), os.path.basename(fname)),
+                           self.path + os.path.basename(fname))
 
     def build_feeds(self):
+        self.site.build_feed_files(list(self.iter_feed_jobs()))
+
+    def iter_feed_jobs(self):
+        # Yields (directory, atomfile, params) for each feed to build
         for subdir in self.directories:
-            subdir.build_feeds()
+            yield from subdir.iter_feed_jobs()
         if not self.site.get_filter(self):
             return
         atomfile = self.site.config.get('feed_atom', self.path)
         if atomfile is not None:
-            self.site.log('ATOM', self.path + atomfile)
-
-            Site._makedirs(self.site.tools_path)
-            for xsltfile in ('pintail-html.xsl', 'pintail-atom.xsl'):
-                xsltpath = os.path.join(self.site.tools_path, xsltfile)
-                if not os.path.exists(xsltpath):
-                    from pkg_resources import resource_string
-                    xsltcont = resource_string(__name__, xsltfile)
-                    fd = open(xsltpath, 'w')
-                    fd.write(codecs.decode(xsltcont, 'utf-8'))
-                    fd.close()
-
-            mal2xhtml = os.path.join(self.site.yelp_xsl_path,
-                                     'xslt', 'mallard', 'html', 'mal2xhtml.xsl')
-
-            atomxsl = os.path.join(self.site.tools_path, 'pintail-atom-local.xsl')
-            fd = open(atomxsl, 'w')
-            fd.write('<xsl:stylesheet' +
-                     ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
-                     ' version="1.0">\n')
-            fd.write('<xsl:import href="' + mal2xhtml + '"/>\n')
-            fd.write('<xsl:import href="pintail-atom.xsl"/>\n')
-            html_extension = self.site.config.get('html_extension') or '.html'
-            fd.write('<xsl:param name="html.extension" select="' +
-                     "'" + html_extension + "'" + '"/>\n')
-            link_extension = self.site.config.get('link_extension')
-            if link_extension is not None:
-                fd.write('<xsl:param name="mal.link.extension" select="' +
-                         "'" + link_extension + "'" + '"/>\n')
-                fd.write('<xsl:param name="pintail.extension.link" select="' +
-                         "'" + link_extension + "'" + '"/>\n')
-            for xsl in self.site.get_custom_xsl():
-                fd.write('<xsl:include href="%s"/>\n' % xsl)
-            fd.write('</xsl:stylesheet>')
-            fd.close()
-
             root = self.site.config.get('feed_root', self.path)
             if root is None:
                 root = self.site.config.get_site_root(self.path)
-
-            subprocess.call(['xsltproc',
-                             '-o', os.path.join(self.get_target_path(), atomfile),
-                             '--stringparam', 'pintail.site.dir', self.path,
-                             '--stringparam', 'pintail.site.root', root,
-                             '--stringparam', 'feed.exclude_styles',
-                             self.site.config.get('feed_exclude_styles', self.path) or '',
-                             atomxsl, self.site.get_cache_path()])
-
+            yield (self, atomfile, {
+                'pintail.site.dir': self.path,
+                'pintail.site.root': root,
+                'feed.exclude_styles':
+                    self.site.config.get('feed_exclude_styles', self.path) or ''
+            })
 
 
 class EmptyDirectory(Directory):
@@ -499,7 +709,15 @@ class Site:
         self.logger = logging.getLogger('pintail')
         self.logger.addHandler(logging.StreamHandler())
 
+        self.manifest = Manifest(self)
+        self.tree_cache = TreeCache(self)
+
         self._filter = []
+        self._pending_pages = None
+        self._loading_pages = None
+        self._html_jobs = None
+
+        self.build_time = datetime.datetime.now()
 
         for plugin in (self.config.get('plugins') or '').split():
             importlib.import_module(plugin)
@@ -520,6 +738,50 @@ class Site:
             transcls = getattr(transmod, trans[dot+1:])
             self.translation_provider = transcls(self)
 
+        # Plugins and providers are all imported, so find hooks now
+        Extendable._hooks.clear()
+        for base, hook in ((ToolsProvider, 'build_tools'), (CssProvider, 'build_css'),
+                           (XslProvider, 'get_xsl'), (XslProvider, 'get_xsl_params'),
+                           (Directory, None), (Directory, 'fetch_directories'),
+                           (Page, 'stage_directory'), (Page, 'get_pages_dir'),
+                           (Page, 'get_pages')):
+            base.get_hooks(hook)
+
+    @property
+    def build_time(self):
+        return self._build_time
+
+    @build_time.setter
+    def build_time(self, value):
+        # Parameter frames have the build date and time
+        self._build_time = value
+        self._xsl_frames = {}
+
+    def get_xsl_param_frame(self, output, directory, lang=None):
+        # The XSLT params shared by every page in a directory, made once
+        # for each output and language
+        key = (output, directory.path, lang)
+        frame = self._xsl_frames.get(key)
+        if frame is not None:
+            return frame
+        frame = {}
+        if output == 'html':
+            html_extension = self.config.get('html_extension') or '.html'
+            if lang is None:
+                frame['html.extension'] = '.html'
+            else:
+                frame['html.extension'] = '.html.' + lang
+            frame['pintail.extension.link'] = self.config.get('link_extension') or html_extension
+        frame['mal.cache.file'] = self.get_cache_path(lang)
+        frame['pintail.site.root'] = self.config.get_site_root(directory.path)
+        frame['pintail.site.dir'] = directory.path
+        if output == 'html':
+            frame['html.output.prefix'] = directory.get_target_path(lang)
+        frame['pintail.date'] = self.build_time.strftime('%Y-%m-%d')
+        frame['pintail.time'] = self.build_time.strftime('%T')
+        self._xsl_frames[key] = frame
+        return frame
+
     @classmethod
     def init_site(cls, directory):
         cfgfile = os.path.join(directory, 'pintail.cfg')
@@ -541,6 +803,10 @@ class Site:
                 fdir = '/' + fdir
             self._filter.append(fdir)
 
+    def is_filtered(self):
+        # True if only some directories or pages are being built
+        return len(self._filter) > 0
+
     def get_filter(self, obj):
         if len(self._filter) == 0:
             return True
@@ -567,7 +833,7 @@ class Site:
         custom_xsl = self.config.get('custom_xsl') or ''
         for x in custom_xsl.split():
             ret.append(os.path.join(self.topdir, x))
-        for cls in XslProvider.iter_subclasses('get_xsl'):
+        for cls in XslProvider.get_hooks('get_xsl'):
             ret.extend(cls.get_xsl(self))
         return ret
 
@@ -603,6 +869,13 @@ class Site:
         else:
             return os.path.join(dirpath, page.target_file + '.' + lang)
 
+    def get_search_target_path(self, domain, lang=None):
+        # Where a static search index for a search domain is written
+        path = os.path.join(self.target_path, domain[1:], 'pintail-search.json.gz')
+        if lang is not None:
+            path += '.' + lang
+        return path
+
     def get_media_target_path(self, directory, mediafile, lang=None):
         if lang is not None:
             langext = '.' + lang
@@ -620,11 +893,37 @@ class Site:
                     return True
             return page.directory.translation_provider.translate_page(page, lang)
 
+    def map_jobs(self, func, tasks, chunksize=1):
+        # Call func(site, *task) for each task, in worker processes if
+        # more than one job is allowed. Results are yielded in order.
+        global _job_site
+        jobs = self.config.get_jobs()
+        if jobs <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield func(self, *task)
+            return
+        _job_site = self
+        context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                    mp_context=context) as executor:
+            yield from executor.map(_run_job, itertools.repeat(func), tasks,
+                                    chunksize=chunksize)
+
+    def get_directory(self, path):
+        # Returns the directory with the site path path, like /foo/bar/
+        directory = self.root
+        while directory is not None and directory.path != path:
+            directory = next((subdir for subdir in directory.directories
+                              if path.startswith(subdir.path)), None)
+        return directory
+
     def read_directories(self):
         if self.root is not None:
             return
-        if os.path.exists(self.get_stage_path()):
-            shutil.rmtree(self.get_stage_path())
+        for cls in Directory.get_hooks('fetch_directories'):
+            cls.fetch_directories(self)
+        if self.config.get_jobs() > 1:
+            self._pending_pages = {}
         self.root = Directory(self, '/')
         directories = {'/': self.root}
         for directory in self.root.iter_directories():
@@ -634,7 +933,7 @@ class Site:
         for path in configdirs:
             if path not in directories:
                 directory = None
-                for cls in Directory.iter_subclasses():
+                for cls in Directory.get_hooks():
                     if cls.is_special_path(self, path):
                         directory = cls(self, path)
                         break
@@ -660,59 +959,132 @@ class Site:
                     if directory.parent is None:
                         directory.parent = directories[parentpath]
 
-    def build(self):
+        if self._pending_pages is not None:
+            self._loading_pages = self._pending_pages
+            self._pending_pages = None
+            self._read_pages_parallel()
+            self._loading_pages = None
+
+    def _read_pages_parallel(self):
+        # Staging and parsing pages happens in worker processes, but
+        # pages are added to their directories here, in the same order
+        # a serial read would add them.
+        tasks = []
+        for directory in self._loading_pages.values():
+            directory.stage_pages()
+            tasks.append((directory.path, None))
+            for name in directory.get_page_files():
+                tasks.append((directory.path, name))
+        by_page_id = {path: {} for path in self._loading_pages}
+        results = self.map_jobs(_load_pages_job, tasks, chunksize=16)
+        for task, pages in zip(tasks, results):
+            directory = self._loading_pages[task[0]]
+            directory.add_pages(pages, by_page_id[task[0]])
+
+    def reload_files(self, paths):
+        # Reload the pages whose sources or dependencies are in paths.
         self.read_directories()
+        paths = set(paths)
+        by_source = {}
+        for directory in self.root.iter_directories():
+            by_source[os.path.normpath(directory.get_source_path())] = directory
+        reload = set()
+        for path in paths:
+            directory = by_source.get(os.path.normpath(os.path.dirname(path)))
+            if directory is not None:
+                reload.add((directory, os.path.basename(path)))
+        for page in self.root.iter_pages():
+            if not paths.isdisjoint(page.get_dependencies()):
+                reload.add((page.directory, page.source_file))
+        for directory, name in reload:
+            directory.reload_pages(name)
+
+    def build(self):
+        # Search runs right after HTML, while the trees that HTML used are
+        # most likely still around. Later phases only use page metadata.
         self.build_cache()
         self.build_tools()
         self.build_html()
+        self.build_search()
         self.build_media()
         self.build_files()
         self.build_feeds()
-        self.build_search()
         if len(self._filter) == 0:
             self.build_css()
             self.build_js()
+        self.tree_cache.log_stats()
 
     def build_cache(self):
         self.read_directories()
-        self.log('CACHE', self.get_cache_path())
-        cache = etree.Element(CACHE_NS + 'cache', nsmap={
-            None: 'http://projectmallard.org/1.0/',
-            'cache': 'http://projectmallard.org/cache/1.0/',
-            'site': 'http://projectmallard.org/site/1.0/',
-            'pintail': 'http://pintail.io/'
-        })
+        # The cache files are written all at once, so they are either
+        # entirely current or rebuilt from scratch.
+        langs = self.get_langs()
+        digests = [self.manifest.get_config_digest()]
         for page in self.root.iter_pages():
-            cdata = page.get_cache_data()
-            if cdata is not None:
-                cache.append(cdata)
+            for lang in [None] + langs:
+                digests.append(self.manifest.get_page_digest(page, lang))
+        digest = None
+        if None not in digests:
+            digest = Manifest.get_digest(*digests)
+        if digest is not None and self.manifest.get_record('cache', 'site') == digest:
+            if all(os.path.exists(self.get_cache_path(lang)) for lang in [None] + langs):
+                return
+        # Each page's cache data is kept as a fragment in the manifest's
+        # fragment store, and only recomputed when the page changes. The
+        # fragments are copied into one root element that declares all
+        # the namespaces they use.
         Site._makedirs(self.tools_path)
-        cache.getroottree().write(self.get_cache_path(),
-                                  pretty_print=True)
-        for lang in self.get_langs():
+        root = etree.Element(CACHE_NS + 'cache', nsmap=CACHE_NS_MAP)
+        root.text = '\n'
+        root = etree.tostring(root, encoding='utf-8')
+        start = root[:root.index(b'>') + 1] + b'\n'
+        end = root[root.rindex(b'<'):] + b'\n'
+        site_ids = set()
+        fragments = set()
+        for lang in [None] + langs:
             self.log('CACHE', self.get_cache_path(lang))
-            cache = etree.Element(CACHE_NS + 'cache', nsmap={
-                None: 'http://projectmallard.org/1.0/',
-                'cache': 'http://projectmallard.org/cache/1.0/',
-                'site': 'http://projectmallard.org/site/1.0/',
-                'pintail': 'http://pintail.io/'
-            })
-            for page in self.root.iter_pages():
-                cdata = page.get_cache_data(lang)
-                if cdata is not None:
-                    cache.append(cdata)
-            cache.getroottree().write(self.get_cache_path(lang),
-                                      pretty_print=True)
+            with open(self.get_cache_path(lang), 'wb') as fd:
+                fd.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+                fd.write(start)
+                for page in self.root.iter_pages():
+                    site_ids.add(page.site_id)
+                    if lang is None:
+                        # Links can change without the page changing, like
+                        # when a subdirectory is added, so they're always
+                        # recorded. They come from the page's summary.
+                        self.manifest.set_page_links(page, page.get_links(),
+                                                     page.get_guide_links(),
+                                                     page.get_topic_links())
+                    fragment = self.manifest.get_cache_fragment(page, lang)
+                    if fragment is None:
+                        if lang is None:
+                            self.manifest.set_page_code_mimes(page, page.get_code_mimes())
+                        cdata = page.get_cache_data(lang)
+                        fragment = self.manifest.set_cache_fragment(page, lang, cdata)
+                    if fragment is not None:
+                        fragments.add(fragment)
+                        with open(fragment, 'rb') as ffd:
+                            shutil.copyfileobj(ffd, fd)
+                fd.write(end)
+        self.manifest.prune_pages(site_ids, fragments)
+        self.manifest.set_record('cache', 'site', digest)
+        self.manifest.save()
 
     def build_tools(self):
+        # The tools directory is stamped with the yelp-xsl commit it was
+        # built from, so yelp-xsl is only built again when it changes.
+        # Generated stylesheets are only written when their text changes.
         Site._makedirs(self.tools_path)
+        offline = self.config.get_offline()
         if os.path.exists(self.yelp_xsl_path):
-            if self.config._update:
+            if self.config._update and not offline:
                 self.log('UPDATE', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
                 p = subprocess.Popen(['git', 'pull', '-q', '-r', 'origin', self.yelp_xsl_branch],
                                      cwd=os.path.join(self.tools_path,
                                                       'yelp-xsl@' + self.yelp_xsl_branch))
                 p.communicate()
+        elif offline:
+            self.logger.error('Cannot find %s while offline' % self.yelp_xsl_path)
         else:
             self.log('CLONE', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
             p = subprocess.Popen(['git', 'clone', '-q',
@@ -721,45 +1093,355 @@ class Site:
                                   self.yelp_xsl_dir],
                                  cwd=self.tools_path)
             p.communicate()
-        self.log('BUILD', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
-        if os.path.exists(os.path.join(self.yelp_xsl_path, 'localbuild.sh')):
-            p = subprocess.Popen([os.path.join(self.yelp_xsl_path, 'localbuild.sh')],
-                                 cwd=self.yelp_xsl_path,
-                                 stdout=subprocess.DEVNULL,
-                                 stderr=subprocess.DEVNULL)
-            p.communicate()
-        else:
-            p = subprocess.Popen([os.path.join(self.yelp_xsl_path, 'autogen.sh')],
-                                 cwd=self.yelp_xsl_path,
-                                 stdout=subprocess.DEVNULL,
-                                 stderr=subprocess.DEVNULL)
-            p.communicate()
-            p = subprocess.Popen(['make'], cwd=self.yelp_xsl_path, stdout=subprocess.DEVNULL)
-            p.communicate()
+
+        stamp = self.get_tools_stamp()
+        commit = self.get_yelp_xsl_commit()
+        if not os.path.exists(self.yelp_xsl_path):
+            commit = None
+        elif commit is None or stamp.get('yelp_xsl') != commit:
+            self.log('BUILD', 'https://gitlab.gnome.org/GNOME/yelp-xsl@' + self.yelp_xsl_branch)
+            if os.path.exists(os.path.join(self.yelp_xsl_path, 'localbuild.sh')):
+                p = subprocess.Popen([os.path.join(self.yelp_xsl_path, 'localbuild.sh')],
+                                     cwd=self.yelp_xsl_path,
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+                p.communicate()
+            else:
+                p = subprocess.Popen([os.path.join(self.yelp_xsl_path, 'autogen.sh')],
+                                     cwd=self.yelp_xsl_path,
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+                p.communicate()
+                if p.returncode == 0:
+                    p = subprocess.Popen(['make'], cwd=self.yelp_xsl_path, stdout=subprocess.DEVNULL)
+                    p.communicate()
+            if p.returncode != 0:
+                commit = None
 
         from pkg_resources import resource_string
         site2html = resource_string(__name__, 'pintail-html.xsl')
-        fd = open(os.path.join(self.tools_path, 'pintail-html.xsl'),
-                  'w', encoding='utf-8')
-        fd.write(codecs.decode(site2html, 'utf-8'))
-        fd.close()
+        self._write_tools_file('pintail-html.xsl', codecs.decode(site2html, 'utf-8'))
 
-        for cls in ToolsProvider.iter_subclasses('build_tools'):
+        for cls in ToolsProvider.get_hooks('build_tools'):
             cls.build_tools(self)
 
+        self.manifest.reset_tools_digest()
+        wrappers = {}
+        for fname in sorted(glob.glob(os.path.join(self.tools_path, 'pintail-html*.xsl'))):
+            wrappers[os.path.basename(fname)] = self.manifest.get_file_hash(fname)
+        newstamp = {'yelp_xsl': commit,
+                    'wrappers': wrappers,
+                    'custom_xsl': self.get_custom_xsl()}
+        if newstamp != stamp:
+            with open(os.path.join(self.tools_path, 'pintail-tools.json'), 'w',
+                      encoding='utf-8') as fd:
+                json.dump(newstamp, fd, sort_keys=True, indent=1)
+
+    def get_tools_stamp(self):
+        try:
+            with open(os.path.join(self.tools_path, 'pintail-tools.json'),
+                      encoding='utf-8') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def get_yelp_xsl_commit(self):
+        return Site.get_git_commit(self.yelp_xsl_path)
+
+    @classmethod
+    def get_git_commit(cls, path):
+        # Read the commit id from the repository's files, so finding out
+        # what we have never needs to run git.
+        gitdir = os.path.join(path, '.git')
+        try:
+            with open(os.path.join(gitdir, 'HEAD')) as fd:
+                head = fd.read().strip()
+            if not head.startswith('ref: '):
+                return head
+            ref = head[5:]
+            refpath = os.path.join(gitdir, ref)
+            if os.path.exists(refpath):
+                with open(refpath) as fd:
+                    return fd.read().strip()
+            with open(os.path.join(gitdir, 'packed-refs')) as fd:
+                for line in fd:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref:
+                        return parts[0]
+        except OSError:
+            pass
+        return None
+
     def build_html(self):
         self.read_directories()
-        self.root.build_html()
+        self.manifest.reset_tools_digest()
+        self._html_jobs = list(self.root.iter_html_jobs())
+        tasks = [(i,) for i in range(len(self._html_jobs))]
+        workers = {}
+        results = self.map_jobs(_build_html_job, tasks, chunksize=4)
+        for done, job, pid in zip(itertools.count(1), self._html_jobs, results):
+            page, lang, digest = job
+            self.manifest.set_record('html', Manifest.get_page_key(page, lang), digest)
+            workers[pid] = workers.get(pid, 0) + 1
+            if pid != os.getpid():
+                self.log('JOBS', '%i/%i pages (worker %i: %i)' %
+                         (done, len(tasks), pid, workers[pid]))
+        self._html_jobs = None
+        self.manifest.save()
 
     def build_media(self):
         self.read_directories()
         self.root.build_media()
 
+    def sync_files(self, section, jobs, prune=False):
+        # Copy (source, target, label) jobs into the built
+        # site. Targets get their source's mtime, so a target with the
+        # same size and mtime is current. Otherwise the source hash is
+        # checked against the manifest. Copies run in threads. If jobs
+        # cover the whole site and prune is True, targets from earlier
+        # builds that no job produced are removed.
+        manifest = self.manifest
+        tag = {'media': 'MEDIA', 'files': 'FILE'}.get(section, section.upper())
+        hardlink = self.config.get('hardlink_files') == 'true'
+        store = self.config.get('media_store') == 'true'
+        targets = set()
+        todo = []
+        for source, target, label in jobs:
+            target = os.path.normpath(target)
+            if target in targets:
+                continue
+            targets.add(target)
+            try:
+                srcst = os.stat(source)
+            except OSError:
+                self.logger.warning('Could not copy file %s' % label)
+                continue
+            if store:
+                # A target is only current if it's a link to the blob for
+                # its source, so turning the store on links old targets.
+                digest = manifest.get_file_hash(source)
+                try:
+                    current = os.path.samefile(target, self.get_store_path(digest))
+                except OSError:
+                    current = False
+                if current:
+                    manifest.set_record(section, target, digest)
+                else:
+                    todo.append((source, target, label, digest))
+                continue
+            try:
+                tgtst = os.stat(target)
+                if (tgtst.st_size == srcst.st_size and
+                    tgtst.st_mtime_ns == srcst.st_mtime_ns):
+                    if manifest.get_record(section, target) is None:
+                        manifest.set_record(section, target,
+                                            manifest.get_file_hash(source))
+                    continue
+            except OSError:
+                tgtst = None
+            digest = manifest.get_file_hash(source)
+            record = manifest.get_record(section, target)
+            if tgtst is not None and record == digest:
+                continue
+            todo.append((source, target, label, digest))
+
+        for dirname in sorted(set(os.path.dirname(job[1]) for job in todo)):
+            Site._makedirs(dirname)
+        def _store(blob):
+            try:
+                self._store_blob(*blob)
+                return True
+            except OSError:
+                return False
+        def _copy(job):
+            try:
+                if store:
+                    Site._copy_file(self.get_store_path(job[3]), job[1], hardlink=True)
+                else:
+                    Site._copy_file(job[0], job[1], hardlink=hardlink)
+                return True
+            except OSError:
+                return False
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.config.get_jobs()) as executor:
+            if store:
+                # Each blob is written once, before any targets link to it
+                blobs = sorted(dict((job[3], job[0]) for job in todo).items())
+                list(executor.map(_store, blobs))
+            for job, res in zip(todo, executor.map(_copy, todo)):
+                if res:
+                    self.log(tag, job[2])
+                    manifest.set_record(section, job[1], job[3])
+                else:
+                    self.logger.warning('Could not copy file %s' % job[2])
+
+        if prune and not self.is_filtered():
+            # Records from a build into another output directory are
+            # forgotten, but that directory's files are left alone.
+            root = os.path.join(os.path.normpath(self.target_path), '')
+            for target, digest in manifest.iter_records(section):
+                if os.path.normpath(target) in targets:
+                    continue
+                if target.startswith(root):
+                    self.log('REMOVE', target)
+                    try:
+                        os.remove(target)
+                    except OSError:
+                        pass
+                manifest.remove_record(section, target)
+            if store:
+                self._prune_store()
+        if store:
+            self._log_store_savings()
+        manifest.save()
+
+    def get_store_path(self, digest):
+        return os.path.join(self.pindir, 'store', digest[:2], digest)
+
+    def _store_blob(self, digest, source):
+        # With media_store = true, built media and extra files are
+        # hardlinks to blobs named by their content hash, so identical
+        # files from different directories and languages share storage.
+        blob = self.get_store_path(digest)
+        if os.path.exists(blob):
+            return blob
+        Site._makedirs(os.path.dirname(blob))
+        Site._copy_file(source, blob)
+        return blob
+
+    def _prune_store(self):
+        storedir = os.path.join(self.pindir, 'store')
+        if not os.path.exists(storedir):
+            return
+        used = set()
+        for section in ('media', 'files'):
+            used.update(digest for target, digest in
+                        self.manifest.iter_records(section))
+        for subdir in os.listdir(storedir):
+            for fname in os.listdir(os.path.join(storedir, subdir)):
+                if fname not in used:
+                    os.remove(os.path.join(storedir, subdir, fname))
+
+    def _log_store_savings(self):
+        inodes = {}
+        targets = set()
+        for section in ('media', 'files'):
+            targets.update(os.path.normpath(target) for target, digest in
+                           self.manifest.iter_records(section))
+        for target in targets:
+            try:
+                st = os.stat(target)
+            except OSError:
+                continue
+            inodes.setdefault((st.st_dev, st.st_ino), []).append(st.st_size)
+        saved = sum(sum(sizes[1:]) for sizes in inodes.values())
+        shared = sum(len(sizes) - 1 for sizes in inodes.values())
+        self.log('STORE', '%i bytes saved, %i duplicate files linked' % (saved, shared))
+
+    @classmethod
+    def _copy_file(cls, source, target, hardlink=False):
+        # Files are written next to the target and moved into place, so
+        # a target that's a hardlink to its source is never written through.
+        tmp = target + '.pintail-tmp'
+        if hardlink:
+            try:
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+                os.link(source, tmp)
+                os.replace(tmp, target)
+                return
+            except OSError:
+                pass
+        with open(source, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            copied = False
+            if hasattr(os, 'copy_file_range'):
+                # Lets the filesystem share blocks where it can
+                try:
+                    size = os.fstat(fsrc.fileno()).st_size
+                    offset = 0
+                    while offset < size:
+                        count = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                                   size - offset)
+                        if count == 0:
+                            break
+                        offset += count
+                    copied = offset >= size
+                except OSError:
+                    pass
+                if not copied:
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+            if not copied:
+                shutil.copyfileobj(fsrc, fdst)
+        st = os.stat(source)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, target)
+
+    def _write_tools_file(self, filename, text):
+        # Leave generated stylesheets alone if they haven't changed, so
+        # their mtimes can be trusted.
+        Site._makedirs(self.tools_path)
+        path = os.path.join(self.tools_path, filename)
+        try:
+            with open(path, encoding='utf-8') as fd:
+                if fd.read() == text:
+                    return path
+        except OSError:
+            pass
+        with open(path, 'w', encoding='utf-8') as fd:
+            fd.write(text)
+        return path
+
     def build_css(self):
         self.read_directories()
 
-        for cls in CssProvider.iter_subclasses('build_css'):
+        for cls in CssProvider.get_hooks('build_css'):
             cls.build_css(self)
+        self.manifest.save()
+
+    def build_css_files(self, name, xsl, docs):
+        # Write pintail-NAME-LOCALE.css for each (locale, getdoc, params)
+        # in docs, using the stylesheet text xsl. getdoc returns the tree
+        # to transform, and is only called for locales that need to be
+        # rendered. Locales are rendered in threads, and locales whose
+        # stylesheets and custom_css haven't changed are skipped.
+        xslfile = self._write_tools_file('pintail-css-' + name + '.xsl', xsl)
+
+        custom_css = self.config.get('custom_css')
+        if custom_css is not None:
+            custom_css = os.path.join(self.topdir, custom_css)
+        digest = Manifest.get_digest(xsl, self.manifest.get_tools_digest(),
+                                     custom_css,
+                                     custom_css and self.manifest.get_file_hash(custom_css))
+
+        jobs = []
+        for locale, getdoc, params in docs:
+            cssfile = 'pintail-' + name + '-' + locale + '.css'
+            csspath = os.path.join(self.target_path, cssfile)
+            if self.manifest.is_current('css', cssfile, digest, csspath):
+                continue
+            jobs.append((cssfile, csspath, getdoc(), params))
+        if len(jobs) == 0:
+            return
+
+        transform = etree.XSLT(etree.parse(xslfile))
+        def _render(job):
+            cssfile, csspath, doc, params = job
+            self.log('CSS', '/' + cssfile)
+            args = {key: etree.XSLT.strparam(value) for key, value in params.items()}
+            return str(transform(doc, **args))
+        custom = ''
+        if custom_css is not None:
+            with open(custom_css, encoding='utf-8') as fd:
+                custom = fd.read()
+        Site._makedirs(self.target_path)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.config.get_jobs()) as executor:
+            for job, css in zip(jobs, executor.map(_render, jobs)):
+                with open(job[1], 'w', encoding='utf-8') as fd:
+                    fd.write(css + custom)
+                self.manifest.set_record('css', job[0], digest)
 
     def build_js(self):
         self.read_directories()
@@ -771,36 +1453,37 @@ class Site:
                             os.path.join(self.target_path, 'jquery.js'))
 
         xslpath = os.path.join(self.yelp_xsl_path, 'xslt')
-        Site._makedirs(self.tools_path)
 
-        jsxsl = os.path.join(self.tools_path, 'pintail-js.xsl')
-        fd = open(jsxsl, 'w')
-        fd.writelines([
+        jsxsl = ''.join([
             '<xsl:stylesheet',
             ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"',
-            ' xmlns:exsl="http://exslt.org/common"',
             ' xmlns:cache="http://projectmallard.org/cache/1.0/"',
             ' xmlns:mal="http://projectmallard.org/1.0/"',
-            ' extension-element-prefixes="exsl"',
             ' version="1.0">\n'
-            '<xsl:import href="', xslpath, '/mallard/html/mal2xhtml.xsl"/>\n'
-            ])
-        fd.write('<xsl:import href="%s"/>\n' % 'pintail-html.xsl')
-        for xsl in self.get_custom_xsl():
-            fd.write('<xsl:include href="%s"/>\n' % xsl)
-        fd.writelines([
+            '<xsl:import href="', xslpath, '/mallard/html/mal2xhtml.xsl"/>\n',
+            '<xsl:import href="%s"/>\n' % 'pintail-html.xsl'
+            ] + [
+            '<xsl:include href="%s"/>\n' % xsl for xsl in self.get_custom_xsl()
+            ] + [
             '<xsl:output method="text"/>\n',
             '<xsl:template match="/">\n',
             ' <xsl:call-template name="html.js.content"/>\n',
             '</xsl:template>\n',
             '</xsl:stylesheet>\n'
             ])
-        fd.close()
-
-        self.log('JS', '/yelp.js')
-        subprocess.call(['xsltproc',
-                         '-o', os.path.join(self.target_path, 'yelp.js'),
-                         jsxsl, self.get_cache_path()])
+        self._write_tools_file('pintail-js.xsl', jsxsl)
+
+        # yelp.js only depends on the stylesheets, not on the pages
+        yelpjs = os.path.join(self.target_path, 'yelp.js')
+        digest = Manifest.get_digest(jsxsl, self.manifest.get_tools_digest())
+        if not self.manifest.is_current('js', 'yelp.js', digest, yelpjs):
+            self.log('JS', '/yelp.js')
+            transform = etree.XSLT(etree.parse(os.path.join(self.tools_path,
+                                                            'pintail-js.xsl')))
+            Site._makedirs(self.target_path)
+            with open(yelpjs, 'w', encoding='utf-8') as fd:
+                fd.write(str(transform(etree.parse(self.get_cache_path()))))
+            self.manifest.set_record('js', 'yelp.js', digest)
 
         if os.path.exists(os.path.join(jspath, 'highlight.pack.js')):
             self.log('JS', '/highlight.pack.js')
@@ -814,26 +1497,21 @@ class Site:
                 shutil.copyfile(os.path.join(jspath, js),
                                 os.path.join(self.target_path, js))
 
-            jsxsl = os.path.join(self.tools_path, 'pintail-js-brushes.xsl')
-            fd = open(jsxsl, 'w')
-            fd.writelines([
+            brushxsl = ''.join([
                 '<xsl:stylesheet',
                 ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"',
                 ' xmlns:mal="http://projectmallard.org/1.0/"',
-                ' xmlns:cache="http://projectmallard.org/cache/1.0/"',
                 ' xmlns:exsl="http://exslt.org/common"',
                 ' xmlns:html="http://www.w3.org/1999/xhtml"',
                 ' extension-element-prefixes="exsl"',
                 ' version="1.0">\n',
                 '<xsl:import href="', xslpath, '/mallard/html/mal2xhtml.xsl"/>\n'
-            ])
-            for xsl in self.get_custom_xsl():
-                fd.write('<xsl:include href="%s"/>\n' % xsl)
-            fd.writelines([
+                ] + [
+                '<xsl:include href="%s"/>\n' % xsl for xsl in self.get_custom_xsl()
+                ] + [
                 '<xsl:output method="text"/>\n',
                 '<xsl:template match="/">\n',
-                '<xsl:for-each select="/cache:cache/mal:page">\n',
-                '<xsl:for-each select="document(@cache:href)//mal:code[@mime]">\n',
+                '<xsl:for-each select="//mal:code[@mime]">\n',
                 '  <xsl:variable name="out">\n',
                 '   <xsl:call-template name="mal2html.pre"/>\n',
                 '  </xsl:variable>\n',
@@ -848,19 +1526,25 @@ class Site:
                 '   <xsl:text>.js&#x000A;</xsl:text>\n',
                 '  </xsl:if>\n',
                 '</xsl:for-each>\n',
-                '</xsl:for-each>\n',
                 '</xsl:template>\n',
                 '</xsl:stylesheet>'
-            ])
-            fd.close()
-
-            brushes = subprocess.check_output(['xsltproc',
-                                               jsxsl, self.get_cache_path()],
-                                              universal_newlines=True)
-            for brush in brushes.split():
+                ])
+            self._write_tools_file('pintail-js-brushes.xsl', brushxsl)
+
+            # Pages record the mime types of their code blocks when they're
+            # read, so brushes are found from one small page with one code
+            # block for each mime type instead of from every page.
+            page = etree.Element(MAL_NS + 'page', nsmap={None: MAL_NS[1:-1]})
+            for mime in sorted(self.manifest.get_code_mimes()):
+                etree.SubElement(page, MAL_NS + 'code', mime=mime)
+            transform = etree.XSLT(etree.parse(os.path.join(self.tools_path,
+                                                            'pintail-js-brushes.xsl')))
+            brushes = str(transform(etree.ElementTree(page)))
+            for brush in sorted(set(brushes.split())):
                 self.log('JS', '/' + brush)
                 shutil.copyfile(os.path.join(jspath, brush),
                                 os.path.join(self.target_path, brush))
+        self.manifest.save()
 
     def build_files(self):
         self.read_directories()
@@ -870,6 +1554,73 @@ class Site:
         self.read_directories()
         self.root.build_feeds()
 
+    def build_feed_files(self, jobs):
+        # The atom stylesheet is compiled once, and all feeds are rendered
+        # in threads against one parsed cache. A feed is skipped if none
+        # of the pages it shows have changed.
+        if len(jobs) == 0:
+            return
+        from pkg_resources import resource_string
+        for xsltfile in ('pintail-html.xsl', 'pintail-atom.xsl'):
+            xsltpath = os.path.join(self.tools_path, xsltfile)
+            if xsltfile == 'pintail-atom.xsl' or not os.path.exists(xsltpath):
+                self._write_tools_file(xsltfile, codecs.decode(
+                    resource_string(__name__, xsltfile), 'utf-8'))
+
+        mal2xhtml = os.path.join(self.yelp_xsl_path,
+                                 'xslt', 'mallard', 'html', 'mal2xhtml.xsl')
+        atomxsl = ('<xsl:stylesheet' +
+                   ' xmlns:xsl="http://www.w3.org/1999/XSL/Transform"' +
+                   ' version="1.0">\n')
+        atomxsl += '<xsl:import href="' + mal2xhtml + '"/>\n'
+        atomxsl += '<xsl:import href="pintail-atom.xsl"/>\n'
+        html_extension = self.config.get('html_extension') or '.html'
+        atomxsl += ('<xsl:param name="html.extension" select="' +
+                    "'" + html_extension + "'" + '"/>\n')
+        link_extension = self.config.get('link_extension')
+        if link_extension is not None:
+            atomxsl += ('<xsl:param name="mal.link.extension" select="' +
+                        "'" + link_extension + "'" + '"/>\n')
+            atomxsl += ('<xsl:param name="pintail.extension.link" select="' +
+                        "'" + link_extension + "'" + '"/>\n')
+        for xsl in self.get_custom_xsl():
+            atomxsl += '<xsl:include href="%s"/>\n' % xsl
+        atomxsl += '</xsl:stylesheet>'
+        atompath = self._write_tools_file('pintail-atom-local.xsl', atomxsl)
+
+        tools = Manifest.get_digest(
+            atomxsl, self.manifest.get_tools_digest(),
+            self.manifest.get_file_hash(os.path.join(self.tools_path, 'pintail-atom.xsl')))
+        todo = []
+        for directory, atomfile, params in jobs:
+            target = os.path.join(directory.get_target_path(), atomfile)
+            parts = [tools, target] + sorted(params.items())
+            for site_id in self.manifest.get_feed_pages(directory,
+                                                        params['feed.exclude_styles']):
+                parts.extend([site_id, self.manifest.get_record('cachedata', site_id)])
+            digest = Manifest.get_digest(*parts)
+            if self.manifest.is_current('feeds', target, digest, target):
+                continue
+            todo.append((directory, atomfile, params, target, digest))
+        if len(todo) == 0:
+            return
+
+        transform = etree.XSLT(etree.parse(atompath))
+        cache = etree.parse(self.get_cache_path())
+        def _render(job):
+            directory, atomfile, params, target, digest = job
+            self.log('ATOM', directory.path + atomfile)
+            args = {key: etree.XSLT.strparam(value) for key, value in params.items()}
+            return bytes(transform(cache, **args))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.config.get_jobs()) as executor:
+            for job, feed in zip(todo, executor.map(_render, todo)):
+                Site._makedirs(os.path.dirname(job[3]))
+                with open(job[3], 'wb') as fd:
+                    fd.write(feed)
+                self.manifest.set_record('feeds', job[3], job[4])
+        self.manifest.save()
+
     def build_search(self):
         if self.config._index:
             self.read_directories()
@@ -909,6 +1660,9 @@ class Config:
         self._local = False
         self._update = True
         self._index = True
+        self._jobs = None
+        self._low_memory = None
+        self._offline = None
 
     def get(self, key, path=None):
         if path is None:
@@ -941,6 +1695,532 @@ class Config:
     def set_index(self, index):
         self._index = index
 
+    def set_jobs(self, jobs):
+        self._jobs = jobs
+
+    def get_jobs(self):
+        if self._jobs is not None:
+            return max(self._jobs, 1)
+        try:
+            return max(int(self.get('jobs') or 1), 1)
+        except ValueError:
+            return 1
+
+    def set_offline(self, offline):
+        self._offline = offline
+
+    def get_offline(self):
+        # Offline builds never clone or update anything with git
+        if self._offline is not None:
+            return self._offline
+        return self.get('offline') == 'true'
+
+    def set_low_memory(self, low_memory):
+        self._low_memory = low_memory
+
+    def get_low_memory(self):
+        if self._low_memory is not None:
+            return self._low_memory
+        return self.get('low_memory') == 'true'
+
+    def get_memory_budget(self):
+        # In bytes, or None if pages keep their trees for the whole build
+        if not self.get_low_memory():
+            return None
+        try:
+            return max(int(self.get('memory_budget') or 512), 0) * 1024 * 1024
+        except ValueError:
+            return 512 * 1024 * 1024
+
+    def get_tree_cache_size(self):
+        try:
+            return max(int(self.get('tree_cache_size') or 64), 0)
+        except ValueError:
+            return 64
+
     def get_directories(self):
         return [d for d in self._config.sections()
                 if d.startswith('/') and d.endswith('/')]
+
+    def get_digest(self):
+        parts = [self._local]
+        for section in self._config.sections():
+            parts.append('[' + section + ']')
+            for key, value in self._config.items(section):
+                parts.extend([key, value])
+        return Manifest.get_digest(*parts)
+
+
+class Manifest:
+    # The manifest records the inputs that went into the last build, so
+    # that build phases can skip outputs that are already current. File
+    # hashes are reused as long as a file's size and mtime are unchanged,
+    # so checking an unchanged file costs one stat call.
+    version = 2
+
+    def __init__(self, site):
+        self.site = site
+        self.path = os.path.join(site.pindir, 'manifest.json')
+        self._files = {}
+        self._oldfiles = {}
+        self._records = {}
+        self._digests = {}
+        self._linkedby = None
+        self._guides = None
+        self._unchanged = []
+        try:
+            with open(self.path, encoding='utf-8') as fd:
+                data = json.load(fd)
+            if data.get('version') == Manifest.version:
+                self._oldfiles = data.get('files', {})
+                self._records = data.get('records', {})
+        except (OSError, ValueError):
+            pass
+
+    def set_unchanged_tree(self, root, changed):
+        # Files under root are known not to have changed since the last
+        # build, except for the paths in changed. Their hashes are reused
+        # without even a stat call.
+        self._unchanged.append((os.path.join(root, ''), set(changed)))
+
+    def get_file_hash(self, path):
+        if path not in self._files and path in self._oldfiles:
+            for root, changed in self._unchanged:
+                if path.startswith(root) and path not in changed:
+                    self._files[path] = self._oldfiles[path]
+                    return self._oldfiles[path][2]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        old = self._files.get(path) or self._oldfiles.get(path)
+        if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+            filehash = old[2]
+        else:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as fd:
+                for block in iter(lambda: fd.read(65536), b''):
+                    sha.update(block)
+            filehash = sha.hexdigest()
+        self._files[path] = [st.st_size, st.st_mtime_ns, filehash]
+        return filehash
+
+    @classmethod
+    def get_digest(cls, *parts):
+        sha = hashlib.sha1()
+        for part in parts:
+            sha.update(str(part).encode('utf-8'))
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    @classmethod
+    def get_page_key(cls, page, lang=None):
+        return Manifest.get_site_id_key(page.site_id, lang)
+
+    @classmethod
+    def get_site_id_key(cls, site_id, lang=None):
+        if lang is None:
+            return site_id
+        return site_id + '@' + lang
+
+    def get_record(self, section, key):
+        return self._records.get(section, {}).get(key)
+
+    def set_record(self, section, key, value):
+        self._records.setdefault(section, {})[key] = value
+
+    def remove_record(self, section, key):
+        self._records.get(section, {}).pop(key, None)
+
+    def iter_records(self, section):
+        # Yields (key, value) pairs. Records can be removed along the way.
+        yield from list(self._records.get(section, {}).items())
+
+    def is_current(self, section, key, digest, target=None):
+        if digest is None:
+            return False
+        if target is not None and not os.path.exists(target):
+            return False
+        return self.get_record(section, key) == digest
+
+    def get_xinclude_dependencies(self, path):
+        # Stored against the hash of the source file, so we only scan
+        # for xi:include elements when the file changes.
+        filehash = self.get_file_hash(path)
+        old = self.get_record('xinclude', path)
+        if old is not None and old[0] == filehash:
+            return old[1]
+        deps = []
+        todo = [path]
+        while len(todo) > 0:
+            cur = todo.pop(0)
+            try:
+                tree = etree.parse(cur)
+            except (OSError, etree.XMLSyntaxError):
+                continue
+            for xi in tree.iter(XI_NS + 'include'):
+                href = xi.get('href')
+                if href is None or ':' in href.split('/')[0]:
+                    continue
+                dep = os.path.normpath(os.path.join(os.path.dirname(cur), href))
+                if dep in deps or dep == path:
+                    continue
+                deps.append(dep)
+                if xi.get('parse', 'xml') == 'xml':
+                    todo.append(dep)
+        self.set_record('xinclude', path, [filehash, deps])
+        return deps
+
+    def get_stage_digest(self, stagepath, deps):
+        parts = [stagepath]
+        for dep in deps:
+            parts.extend([dep, self.get_file_hash(dep)])
+        return Manifest.get_digest(*parts)
+
+    def is_stage_current(self, stagepath, deps):
+        return self.is_current('stage', stagepath,
+                               self.get_stage_digest(stagepath, deps), stagepath)
+
+    def set_stage_current(self, stagepath, deps):
+        if os.path.exists(stagepath):
+            self.set_record('stage', stagepath, self.get_stage_digest(stagepath, deps))
+
+    def get_config_digest(self):
+        if 'config' not in self._digests:
+            self._digests['config'] = Manifest.get_digest(
+                self.site.config.get_digest(), self.site.target_path)
+        return self._digests['config']
+
+    def get_tools_digest(self):
+        if 'tools' not in self._digests:
+            parts = []
+            for fname in sorted(glob.glob(os.path.join(self.site.tools_path,
+                                                       'pintail-html*.xsl'))):
+                parts.extend([fname, self.get_file_hash(fname)])
+            for xsl in self.site.get_custom_xsl():
+                parts.extend([xsl, self.get_file_hash(xsl)])
+            parts.append(self.site.get_yelp_xsl_commit())
+            self._digests['tools'] = Manifest.get_digest(*parts)
+        return self._digests['tools']
+
+    def reset_tools_digest(self):
+        self._digests.pop('tools', None)
+
+    def reset(self):
+        self._digests = {}
+
+    def get_page_digest(self, page, lang=None):
+        # For translated pages, the translation provider has to tell us
+        # which files the translation uses. If it can't, there's no
+        # digest, and the page is always rebuilt.
+        key = (page.site_id, lang)
+        if key in self._digests:
+            return self._digests[key]
+        parts = [page.site_id, page.get_stage_path(lang)]
+        for dep in page.get_dependencies():
+            parts.extend([dep, self.get_file_hash(dep)])
+        if lang is not None:
+            trfiles = None
+            if page.directory.translation_provider is not None:
+                trfiles = page.directory.translation_provider.get_translation_files(page, lang)
+            if trfiles is None:
+                self._digests[key] = None
+                return None
+            parts.append(lang)
+            for trfile in trfiles:
+                parts.extend([trfile, self.get_file_hash(trfile)])
+        self._digests[key] = Manifest.get_digest(*parts)
+        return self._digests[key]
+
+    def set_page_links(self, page, links, guides=(), topics=()):
+        self.set_record('links', page.site_id, sorted(links))
+        self.set_record('guides', page.site_id, sorted(guides))
+        self.set_record('topics', page.site_id, sorted(topics))
+        self._linkedby = None
+
+    def set_page_code_mimes(self, page, mimes):
+        self.set_record('mimes', page.site_id, sorted(mimes))
+
+    def get_code_mimes(self):
+        # Pages that haven't had their cache data recomputed since this
+        # was added to the manifest are asked directly.
+        mimes = set()
+        for page in self.site.root.iter_pages():
+            pagemimes = self.get_record('mimes', page.site_id)
+            if pagemimes is None:
+                pagemimes = page.get_code_mimes()
+                self.set_page_code_mimes(page, pagemimes)
+            mimes.update(pagemimes)
+        return mimes
+
+    def get_feed_pages(self, directory, exclude_styles=''):
+        # The site ids of the pages an atom feed for directory shows. As in
+        # pintail-atom.xsl, that's pages with the same site:dir, less those
+        # with the excluded style. Styles are read from stored fragments.
+        ret = []
+        for page in directory.pages:
+            fragment = self.get_record('cachedata', page.site_id)
+            if fragment is None:
+                continue
+            if exclude_styles != '':
+                try:
+                    for event, node in etree.iterparse(self.get_fragment_path(fragment),
+                                                       events=('start',)):
+                        style = node.get('style', '')
+                        break
+                except (OSError, etree.Error):
+                    style = ''
+                if (' ' + exclude_styles + ' ') in (' ' + style + ' '):
+                    continue
+            ret.append(page.site_id)
+        return ret
+
+    def get_fragment_path(self, fragment):
+        return os.path.join(self.site.pindir, 'cache', fragment[:2], fragment + '.xml')
+
+    def get_cache_fragment(self, page, lang=None):
+        # Returns the path to the stored cache data for a page, if the
+        # page hasn't changed since it was stored.
+        key = Manifest.get_page_key(page, lang)
+        digest = self.get_page_digest(page, lang)
+        if digest is None:
+            return None
+        digest = Manifest.get_digest(digest, self.get_config_digest())
+        if self.get_record('cacheinputs', key) != digest:
+            return None
+        fragment = self.get_record('cachedata', key)
+        if fragment is None:
+            return None
+        path = self.get_fragment_path(fragment)
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def set_cache_fragment(self, page, lang, cdata):
+        key = Manifest.get_page_key(page, lang)
+        digest = self.get_page_digest(page, lang)
+        if digest is not None:
+            digest = Manifest.get_digest(digest, self.get_config_digest())
+        self.set_record('cacheinputs', key, digest)
+        if cdata is None:
+            self.set_record('cachedata', key, None)
+            return None
+        # Serialize inside a cache element and keep only its content. The
+        # fragment then uses the prefixes the cache file declares, and can
+        # be copied into it as it is.
+        cache = etree.Element(CACHE_NS + 'cache', nsmap=CACHE_NS_MAP)
+        cache.append(cdata)
+        cdata.tail = '\n'
+        data = etree.tostring(cache, encoding='utf-8')
+        data = data[data.index(b'>') + 1:data.rindex(b'<')]
+        fragment = hashlib.sha1(data).hexdigest()
+        self.set_record('cachedata', key, fragment)
+        path = self.get_fragment_path(fragment)
+        if not os.path.exists(path):
+            Site._makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fd:
+                fd.write(data)
+        return path
+
+    def prune_pages(self, site_ids, fragments):
+        # Forget pages that no longer exist, and remove stored fragments
+        # that no page uses.
+        for section in ('links', 'guides', 'topics', 'mimes',
+                        'cacheinputs', 'cachedata'):
+            records = self._records.get(section, {})
+            for key in list(records.keys()):
+                if key.split('@')[0] not in site_ids:
+                    del records[key]
+        self._linkedby = None
+        cachedir = os.path.join(self.site.pindir, 'cache')
+        if os.path.exists(cachedir):
+            for subdir in os.listdir(cachedir):
+                for fname in os.listdir(os.path.join(cachedir, subdir)):
+                    path = os.path.join(cachedir, subdir, fname)
+                    if path not in fragments:
+                        os.remove(path)
+
+    def get_related_pages(self, page):
+        # A page's HTML shows cache data from the pages it links to, the
+        # pages that link to it, the guides in its link trails, and the
+        # index pages in its site trail.
+        if self._linkedby is None:
+            self._linkedby = {}
+            self._guides = {}
+            for site_id, links in self._records.get('links', {}).items():
+                for link in links:
+                    self._linkedby.setdefault(link, set()).add(site_id)
+            for site_id, guides in self._records.get('guides', {}).items():
+                self._guides.setdefault(site_id, set()).update(guides)
+            for site_id, topics in self._records.get('topics', {}).items():
+                for topic in topics:
+                    self._guides.setdefault(topic, set()).add(site_id)
+        related = set(self.get_record('links', page.site_id) or [])
+        related.update(self._linkedby.get(page.site_id, []))
+        guides = set()
+        todo = [page.site_id]
+        while len(todo) > 0:
+            for guide in self._guides.get(todo.pop(), []):
+                if guide not in guides:
+                    guides.add(guide)
+                    todo.append(guide)
+        related.update(guides)
+        path = '/'
+        for part in page.directory.path.split('/')[1:]:
+            related.add(path + 'index')
+            path = path + part + '/'
+        related.discard(page.site_id)
+        return sorted(related)
+
+    def get_html_digest(self, page, lang=None):
+        pagedigest = self.get_page_digest(page, lang)
+        if pagedigest is None:
+            return None
+        parts = [pagedigest, self.get_config_digest(), self.get_tools_digest(),
+                 self.get_record('cachedata', Manifest.get_page_key(page, lang))]
+        for site_id in self.get_related_pages(page):
+            parts.extend([site_id,
+                          self.get_record('cachedata',
+                                          Manifest.get_site_id_key(site_id, lang))])
+        return Manifest.get_digest(*parts)
+
+    def save(self):
+        files = self._oldfiles.copy()
+        files.update(self._files)
+        Site._makedirs(self.site.pindir)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fd:
+            json.dump({'version': Manifest.version,
+                       'files': files,
+                       'records': self._records},
+                      fd, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+
+class TreeCache:
+    # Parsed trees for translated pages, shared by all page types. Only
+    # the most recently used trees are kept, so memory use is bounded by
+    # the tree_cache_size config key rather than by pages times langs.
+    #
+    # In low-memory mode, pages also hold their own trees here, and the
+    # least recently used trees are dropped whenever the estimated size
+    # of all held trees goes over the memory budget. Pages keep enough
+    # metadata to read the site without their trees, and parse their
+    # staged files again when they need them.
+
+    # lxml trees take several times the size of their source in memory.
+    tree_size_factor = 8
+
+    def __init__(self, site):
+        self.site = site
+        self.capacity = site.config.get_tree_cache_size()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._used = 0
+        self._trees = collections.OrderedDict()
+        self._tree_data = {}
+        self._pages = collections.OrderedDict()
+        self._releasing = None
+
+    def __len__(self):
+        return len(self._trees)
+
+    @classmethod
+    def get_tree_size(cls, path):
+        try:
+            return os.path.getsize(path) * cls.tree_size_factor
+        except OSError:
+            return 0
+
+    def get_tree(self, path):
+        entry = self._trees.get(path)
+        if entry is not None:
+            self.hits += 1
+            self._trees.move_to_end(path)
+            return entry[0]
+        self.misses += 1
+        tree = etree.parse(path)
+        if self.capacity > 0:
+            size = self.get_tree_size(path)
+            self._trees[path] = (tree, size)
+            self._used += size
+            while len(self._trees) > self.capacity:
+                self._evict()
+            self._shrink(keep=path)
+        return tree
+
+    def get_tree_data(self, path, name, func):
+        # Returns func(tree) for the tree at path, computing it only once
+        # while the tree is cached. Data is dropped along with its tree,
+        # so things like id indexes never keep evicted trees alive.
+        tree = self.get_tree(path)
+        if path not in self._trees:
+            return func(tree)
+        data = self._tree_data.setdefault(path, {})
+        if name not in data:
+            data[name] = func(tree)
+        return data[name]
+
+    def _evict(self):
+        path, entry = self._trees.popitem(last=False)
+        self._tree_data.pop(path, None)
+        self._used -= entry[1]
+        self.evictions += 1
+
+    def hold_page(self, page):
+        # Called by pages whenever they use their own tree. Does nothing
+        # unless we're in low-memory mode.
+        if self.site.config.get_memory_budget() is None:
+            return
+        if page is self._releasing:
+            return
+        if page in self._pages:
+            self._pages.move_to_end(page)
+            return
+        size = self.get_tree_size(page.get_stage_path())
+        self._pages[page] = size
+        self._used += size
+        self._shrink(keep=page)
+
+    def _shrink(self, keep=None):
+        budget = self.site.config.get_memory_budget()
+        if budget is None:
+            return
+        # Translated trees go first, because they're only used when
+        # building output for one language.
+        while self._used > budget and len(self._trees) > 0:
+            if next(iter(self._trees)) == keep:
+                break
+            self._evict()
+        while self._used > budget and len(self._pages) > 0:
+            page = next(iter(self._pages))
+            if page is keep:
+                break
+            self._used -= self._pages.pop(page)
+            # Releasing reads metadata from the tree, which holds it again
+            self._releasing = page
+            try:
+                page.release_tree()
+            finally:
+                self._releasing = None
+            self.evictions += 1
+
+    def discard(self, path):
+        entry = self._trees.pop(path, None)
+        self._tree_data.pop(path, None)
+        if entry is not None:
+            self._used -= entry[1]
+
+    def discard_page(self, page):
+        self._used -= self._pages.pop(page, 0)
+
+    def clear(self):
+        self._trees.clear()
+        self._tree_data.clear()
+        self._pages.clear()
+        self._used = 0
+
+    def log_stats(self):
+        self.site.log('TREES', '%i hits, %i misses, %i evictions' %
+                      (self.hits, self.misses, self.evictions))
@@ -42,5 +42,10 @@ class TranslationProvider(pintail.site.Extendable):
     def translate_page(self, page, lang):
         return False
 
+    def get_translation_files(self, page, lang):
+        # Return None if the files can't be known, in which case the
+        # translated page is always rebuilt.
+        return None
+
     def translate_media(self, directory, mediafile, lang):
         return False
@@ -0,0 +1,172 @@
+# pintail - Build static sites from collections of Mallard documents
+# Copyright (c) 2016 Shaun McCance <shaunm@gnome.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import ctypes.util
+import datetime
+import os
+import select
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+           IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+
+class PollWatcher:
+    def __init__(self, paths, interval=1.0):
+        self.paths = paths
+        self.interval = interval
+        self._stats = self._scan()
+
+    def _scan(self):
+        ret = {}
+        for path in self.paths:
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = [d for d in dirnames
+                               if d not in ('__pintail__', '.git')]
+                for fname in filenames:
+                    fpath = os.path.join(dirpath, fname)
+                    try:
+                        st = os.stat(fpath)
+                    except OSError:
+                        continue
+                    ret[fpath] = (st.st_size, st.st_mtime_ns)
+        return ret
+
+    def wait(self):
+        while True:
+            time.sleep(self.interval)
+            stats = self._scan()
+            changed = set()
+            for fpath in set(stats) | set(self._stats):
+                if stats.get(fpath) != self._stats.get(fpath):
+                    changed.add(fpath)
+            self._stats = stats
+            if len(changed) > 0:
+                return changed
+
+
+class InotifyWatcher:
+    def __init__(self, paths, delay=0.2):
+        self.paths = paths
+        self.delay = delay
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+        for path in paths:
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = [d for d in dirnames
+                               if d not in ('__pintail__', '.git')]
+                self._add_watch(dirpath)
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), IN_MASK)
+        if wd >= 0:
+            self._watches[wd] = path
+
+    def _read_events(self, changed):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+            name = data[pos + 16:pos + 16 + length].rstrip(b'\0')
+            pos += 16 + length
+            if wd not in self._watches or len(name) == 0:
+                continue
+            fpath = os.path.join(self._watches[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if os.path.basename(fpath) not in ('__pintail__', '.git'):
+                        self._add_watch(fpath)
+                continue
+            changed.add(fpath)
+
+    def wait(self):
+        changed = set()
+        while len(changed) == 0:
+            select.select([self._fd], [], [])
+            self._read_events(changed)
+            # Editors tend to write files in several steps. Wait for
+            # things to settle before reporting changes.
+            while len(select.select([self._fd], [], [], self.delay)[0]) > 0:
+                self._read_events(changed)
+        return changed
+
+
+def get_watcher(paths, poll=False):
+    if not poll:
+        try:
+            return InotifyWatcher(paths)
+        except (AttributeError, OSError):
+            pass
+    return PollWatcher(paths)
+
+
+def watch_site(site, poll=False):
+    # The site keeps its pages and compiled stylesheets between builds,
+    # and the manifest skips anything a change didn't affect.
+    site.build()
+    paths = []
+    for directory in site.root.iter_directories():
+        path = os.path.normpath(directory.get_source_path())
+        if os.path.isdir(path) and not any(path.startswith(p + '/') or path == p
+                                           for p in paths):
+            paths.append(path)
+    watcher = get_watcher(paths, poll=poll)
+    site.logger.warning('Watching %i directories for changes' % len(paths))
+    while True:
+        changed = watcher.wait()
+        # Don't rebuild because we wrote output into a watched directory
+        outputs = [site.target_path, site.tools_path,
+                   site.get_stage_path()] + [site.get_stage_path(lang)
+                                             for lang in site.get_langs()]
+        changed = [path for path in changed
+                   if not any(path.startswith(out + '/') for out in outputs)]
+        if len(changed) == 0:
+            continue
+        for path in sorted(changed):
+            site.log('CHANGE', path)
+        site.build_time = datetime.datetime.now()
+        tools = site.manifest.get_tools_digest()
+        site.manifest.reset()
+        try:
+            site.reload_files(changed)
+            if site.manifest.get_tools_digest() != tools:
+                # A custom stylesheet changed. Write the tools again, and
+                # have page types compile their stylesheets again.
+                site.build_tools()
+            site.build_cache()
+            site.build_html()
+            site.build_media()
+            site.build_files()
+        except Exception as e:
+            site.logger.error('Build failed: %s' % e)